@@ -1,2 +1,10 @@
-from .writer import dump, dumps, IllegalKeyChar, WrongKeyType, MultiTypeArray
-from .reader import load, loads
\ No newline at end of file
+from .writer import dump, dumps, iterdump, IllegalKeyChar, WrongKeyType, MultiTypeArray, CircularReference
+from .reader import load, loads, iterparse, load_lazy, ParseCache, parse_cache, memoize_datetimes
+from .index import TableIndex, get
+from .diskcache import DiskCache
+from .bulk import load_many, dump_many
+from .aio import aload, aloads, adump, adumps
+from .incremental import IncrementalParser
+from .stats import Stats
+from .compiled import compile_writer
+from .columns import Columns, Row
@@ -0,0 +1,74 @@
+# coding: utf-8
+# tomlaio.py
+"""
+Loads and dumps TOML from asyncio code without blocking the event loop
+"""
+
+import asyncio
+
+from .reader import load, loads, parse_steps
+from .writer import TomlWriter
+
+def read_text(path):
+    """Reads the text of the file at the given path"""
+    with open(path) as f:
+        return f.read()
+
+def write_text(path, text):
+    """Writes the given text to the file at the given path"""
+    with open(path, "w") as f:
+        f.write(text)
+
+async def aloads(string, executor=None, step=1000, engine="regex"):
+    """Loads a dictionary from the given string.
+    If an executor is given, the string is parsed in it. If not, it is parsed
+    in the event loop, which gets to run other tasks every 'step' statements
+    (or never, if 'step' is 0)"""
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, loads, string, engine)
+
+    data = {}
+    for _ in parse_steps(string.split("\n"), engine, data, step=step):
+        await asyncio.sleep(0)
+    return data
+
+async def aload(path, executor=None, step=1000, engine="regex"):
+    """Loads TOML from the given file path. The file is read in a thread of the
+    default executor, and parsed like with 'aloads'"""
+    loop = asyncio.get_running_loop()
+    if executor is not None:
+        return await loop.run_in_executor(executor, load, path, engine)
+    text = await loop.run_in_executor(None, read_text, path)
+    return await aloads(text, None, step, engine)
+
+async def adumps(data, executor=None, step=1000):
+    """Dumps the given data as a string.
+    If an executor is given, the data is dumped in it. If not, it is dumped in
+    the event loop, which gets to run other tasks every 'step' lines (or never,
+    if 'step' is 0)"""
+    writer = TomlWriter()
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, writer.dumps, data)
+
+    writer.reset()
+    lines = []
+    for line in writer.iter_lines(data):
+        lines.append(line)
+        if step and (len(lines) % step == 0):
+            await asyncio.sleep(0)
+    return "\n".join(lines)
+
+async def adump(data, path, executor=None, step=1000):
+    """Dumps the given data to the file at the given path. The data is dumped
+    like with 'adumps', and written in a thread of the default executor"""
+    text = await adumps(data, executor, step)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, write_text, path, text + "\n")
+
+def test_step():
+    """Checks that a 'step' of 0 never pauses, both when loading and dumping"""
+    data = {"a": 1, "b": {"c": [1, 2]}}
+    text = asyncio.run(adumps(data, step=0))
+    assert asyncio.run(aloads(text, step=0)) == data
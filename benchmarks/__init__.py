@@ -0,0 +1,6 @@
+# coding: utf-8
+# benchmarks/__init__.py
+"""
+Benchmarks of the reader and the writer on generated documents.
+Run them with 'python -m friendlytoml.benchmarks.run'
+"""
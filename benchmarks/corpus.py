@@ -0,0 +1,92 @@
+# coding: utf-8
+# benchmarks/corpus.py
+"""
+Generates TOML documents of the shapes that the benchmarks measure
+"""
+
+import random
+
+def wide(tables=200, keys=50):
+    """Many flat tables with many keys each"""
+    lines = []
+    for table in range(tables):
+        lines.append("[table{}]".format(table))
+        for key in range(keys):
+            if key % 3 == 0:
+                lines.append('key{} = "value {} of table {}"'.format(key, key, table))
+            elif key % 3 == 1:
+                lines.append("key{} = {}".format(key, key * table))
+            else:
+                lines.append("key{} = {}.5".format(key, key))
+        lines.append("")
+    return "\n".join(lines)
+
+def deep(depth=30, branches=300):
+    """Deeply nested [a.b.c...] headers"""
+    lines = []
+    for branch in range(branches):
+        path = ["branch{}".format(branch)]
+        for level in range(depth):
+            path.append("level{}".format(level))
+            lines.append("[{}]".format(".".join(path)))
+            lines.append("value = {}".format(level))
+        lines.append("")
+    return "\n".join(lines)
+
+def array_tables(count=10000):
+    """A long [[array]] of small tables"""
+    lines = []
+    for num in range(count):
+        lines.append("[[items]]")
+        lines.append("id = {}".format(num))
+        lines.append('name = "item {}"'.format(num))
+        lines.append("price = {}.99".format(num % 100))
+        lines.append("")
+    return "\n".join(lines)
+
+def numeric(arrays=50, length=10000, seed=0):
+    """Big arrays of integers and floats"""
+    rng = random.Random(seed)
+    lines = []
+    for num in range(arrays):
+        if num % 2:
+            values = [str(rng.randint(-10**6, 10**6)) for _ in range(length)]
+        else:
+            values = [repr(rng.uniform(-1000, 1000)) for _ in range(length)]
+        # Break the arrays into lines like a person would
+        rows = [", ".join(values[i:i + 20]) for i in range(0, length, 20)]
+        lines.append("array{} = [\n    {}\n]".format(num, ",\n    ".join(rows)))
+    return "\n".join(lines)
+
+def big_strings(count=4, size=2 * 1024 * 1024):
+    """Multi-MB triple-quoted strings"""
+    line = "The quick brown fox jumps over the lazy dog. " * 2
+    body = "\n".join([line] * (size // (len(line) + 1)))
+    return "\n".join('text{} = """\n{}"""'.format(num, body) for num in range(count))
+
+def datetimes(tables=2000, keys=10):
+    """Tables full of datetimes with and without timezones"""
+    lines = []
+    for table in range(tables):
+        lines.append("[event{}]".format(table))
+        for key in range(keys):
+            day = key % 28 + 1
+            if key % 3 == 0:
+                lines.append("time{} = 1996-12-{:02}T16:39:57Z".format(key, day))
+            elif key % 3 == 1:
+                lines.append("time{} = 1996-12-{:02}T16:39:57-08:00".format(key, day))
+            else:
+                lines.append("time{} = 1996-12-{:02}T16:39:57.123456+05:30".format(
+                    key, day))
+        lines.append("")
+    return "\n".join(lines)
+
+# name: generator
+generators = {
+    "wide": wide,
+    "deep": deep,
+    "array_tables": array_tables,
+    "numeric": numeric,
+    "big_strings": big_strings,
+    "datetimes": datetimes,
+}
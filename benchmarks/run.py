@@ -0,0 +1,125 @@
+# coding: utf-8
+# benchmarks/run.py
+"""
+Measures tokenizing, loading and dumping the generated documents, and saves
+the results as JSON so that runs can be compared
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from ..reader import loads, tokenizers
+from ..writer import TomlWriter
+from .corpus import generators
+
+def tokenize_all(tokenize, text):
+    """Tokenizes the text and returns the number of tokens"""
+    count = 0
+    for (_, line) in tokenize(text.split("\n")):
+        count += len(line)
+    return count
+
+def measure(function, repeat):
+    """Returns the best time of 'repeat' calls, and the peak memory of one
+    call (measured separately, since tracemalloc slows things down)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def run_document(name, text, repeat, engines):
+    """Benchmarks every phase on the given document, and returns a list of
+    results"""
+    size = len(text.encode("utf-8"))
+    tokens = tokenize_all(tokenizers[engines[0]], text)
+    data = loads(text, engines[0])
+    writer = TomlWriter()
+
+    phases = []
+    for engine in engines:
+        phases.append(("tokenize", engine,
+            lambda engine=engine: tokenize_all(tokenizers[engine], text)))
+    for engine in engines:
+        phases.append(("loads", engine, lambda engine=engine: loads(text, engine)))
+    phases.append(("dumps", None, lambda: writer.dumps(data)))
+    phases.append(("dump", None, lambda: writer.dump(data, io.StringIO())))
+
+    results = []
+    for (phase, engine, function) in phases:
+        seconds, peak = measure(function, repeat)
+        results.append({
+            "document": name,
+            "phase": phase,
+            "engine": engine,
+            "bytes": size,
+            "tokens": tokens,
+            "seconds": seconds,
+            "mb_per_s": size / seconds / 1e6,
+            "tokens_per_s": tokens / seconds,
+            "peak_bytes": peak,
+        })
+    return results
+
+def print_result(result):
+    """Prints a result as a row of the table"""
+    phase = result["phase"]
+    if result["engine"]:
+        phase += " (" + result["engine"] + ")"
+    print("{:<14} {:<18} {:>9.2f} MB/s {:>12,.0f} tokens/s {:>10.1f} MB peak".format(
+        result["document"], phase, result["mb_per_s"], result["tokens_per_s"],
+        result["peak_bytes"] / 1e6))
+
+def main(args=None):
+    """entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("documents", nargs="*",
+        help="the documents to run (all by default): " + ", ".join(generators))
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+        help="how many times to run each phase (the best time is used)")
+    parser.add_argument("-e", "--engine", action="append",
+        choices=sorted(tokenizers), help="the tokenizers to run (all by default)")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+        help="where to save the results")
+    options = parser.parse_args(args)
+
+    names = options.documents or list(generators)
+    for name in names:
+        if name not in generators:
+            parser.error("unknown document '{}'".format(name))
+    engines = options.engine or list(tokenizers)
+    results = []
+    for name in names:
+        text = generators[name]()
+        for result in run_document(name, text, options.repeat, engines):
+            print_result(result)
+            results.append(result)
+
+    with open(options.output, "w") as f:
+        json.dump({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "repeat": options.repeat,
+            "results": results,
+        }, f, indent=2)
+    print("Saved the results to {}".format(os.path.abspath(options.output)))
+
+if __name__ == '__main__':
+    main()
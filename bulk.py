@@ -0,0 +1,56 @@
+# coding: utf-8
+# tomlbulk.py
+"""
+Loads and dumps many TOML files at once, spread over a pool of processes
+"""
+
+import concurrent.futures
+
+from .reader import load
+from .writer import dump
+
+def load_one(args):
+    """Loads a single file, and returns (data, error) instead of raising"""
+    path, engine = args
+    try:
+        return (load(path, engine), None)
+    except Exception as e:
+        return (None, e)
+
+def dump_one(args):
+    """Dumps data to a single file, and returns the error (if any) instead of
+    raising"""
+    data, path = args
+    try:
+        with open(path, "w") as f:
+            dump(data, f)
+        return None
+    except Exception as e:
+        return e
+
+def run_many(function, tasks, workers, chunksize):
+    """Runs the function on each task in a process pool (or in this process,
+    with one worker), and returns the results in order"""
+    if workers == 1:
+        return [function(task) for task in tasks]
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(function, tasks, chunksize=chunksize))
+
+def load_many(paths, workers=None, chunksize=16, engine="regex"):
+    """Loads the files at the given paths using 'workers' processes (one per
+    CPU by default), sending them to the processes 'chunksize' at a time.
+    Returns a list of (path, data, error) in the same order as the paths,
+    where either the data or the error is None"""
+    paths = list(paths)
+    results = run_many(load_one, [(path, engine) for path in paths],
+        workers, chunksize)
+    return [(path, data, error) for (path, (data, error)) in zip(paths, results)]
+
+def dump_many(items, workers=None, chunksize=16):
+    """Dumps each (data, path) in the given items using 'workers' processes
+    (one per CPU by default), sending them 'chunksize' at a time.
+    Returns a list of (path, error) in the same order, where the error is None
+    for the files that were written"""
+    items = list(items)
+    errors = run_many(dump_one, items, workers, chunksize)
+    return [(path, error) for ((_, path), error) in zip(items, errors)]
@@ -0,0 +1,236 @@
+# coding: utf-8
+# columns.py
+"""
+Stores arrays of tables as columns, with one list of values per key, which
+takes much less memory than a dictionary per table
+"""
+
+import array
+import collections.abc
+
+# The value of a key that a table doesn't have
+MISSING = object()
+
+# array.array type codes for columns of only ints or only floats
+typecodes = {
+    int: "q",
+    float: "d"
+}
+packed_types = {typecode: t for (t, typecode) in typecodes.items()}
+
+class Row(collections.abc.MutableMapping):
+    """A view of one table of a Columns, which works like a dictionary"""
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        column = self.table.columns.get(key)
+        if column is None:
+            raise KeyError(key)
+        value = column[self.index]
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.table.set(self.index, key, value)
+
+    def __delitem__(self, key):
+        self[key] # Complain if it isn't there
+        self.table.set(self.index, key, MISSING)
+
+    def __iter__(self):
+        index = self.index
+        for (key, column) in self.table.columns.items():
+            if column[index] is not MISSING:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "Row({})".format(dict(self))
+
+class Columns(collections.abc.Sequence):
+    """An array of tables (like the list of dictionaries of [[array]]),
+    stored as a list of values for each key. The key names are only stored
+    once, columns of only ints or only floats are packed into array.array,
+    and the tables are Row views that are made when they are accessed"""
+    __slots__ = ("columns", "length")
+
+    def __init__(self, rows=()):
+        self.columns = {} # key: list (or array.array) of values
+        self.length = 0
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return Columns(self[num] for num in range(*index.indices(self.length)))
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("Columns index out of range")
+        return Row(self, index)
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield Row(self, index)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, Columns)):
+            return (len(self) == len(other)) and all(
+                row == other_row for (row, other_row) in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Columns({})".format(self.to_list())
+
+    def column(self, key):
+        """Returns the values of the given key, with MISSING for the tables
+        that don't have it"""
+        return self.columns[key]
+
+    def append(self, row):
+        """Adds a table (a dictionary or Row) to the end"""
+        for key in row:
+            if key not in self.columns:
+                self.columns[key] = [MISSING] * self.length
+        length = self.length
+        for (key, column) in self.columns.items():
+            value = row.get(key, MISSING)
+            if (type(column) is array.array) and (
+                    type(value) is not packed_types[column.typecode]):
+                column = self.unpack(key)
+            column.append(value)
+        self.length = length + 1
+
+    def set(self, index, key, value):
+        """Sets the value of a key in the table at the given index"""
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[key] = [MISSING] * self.length
+        elif (type(column) is array.array) and (
+                type(value) is not packed_types[column.typecode]):
+            column = self.unpack(key)
+        column[index] = value
+
+    def unpack(self, key):
+        """Turns a packed column back into a list, and returns it"""
+        column = self.columns[key] = self.columns[key].tolist()
+        return column
+
+    def pack(self):
+        """Packs the columns of only ints or only floats into array.array"""
+        for (key, column) in self.columns.items():
+            if (type(column) is not list) or (not column):
+                continue
+            types = set(map(type, column))
+            if len(types) != 1:
+                continue
+            typecode = typecodes.get(types.pop())
+            if typecode is None:
+                continue
+            try:
+                self.columns[key] = array.array(typecode, column)
+            except OverflowError:
+                # Ints that don't fit in 64 bits
+                pass
+
+    def to_list(self):
+        """Returns the tables as a list of dictionaries"""
+        return [dict(row) for row in self]
+
+def to_columns(data):
+    """Replaces the arrays of tables in the given loaded data (also the ones
+    inside other arrays of tables) with packed Columns, and returns it"""
+    converted = {} # id: Columns, for arrays found more than once
+    visited = set() # The ids of the dictionaries
+
+    def convert(value):
+        t = type(value)
+        if t is dict:
+            if id(value) in visited:
+                return value
+            visited.add(id(value))
+            for (key, item) in value.items():
+                value[key] = convert(item)
+        elif id(value) in converted:
+            return converted[id(value)]
+        elif (t is list) and value and all(type(item) is dict for item in value):
+            table = converted[id(value)] = Columns()
+            for (num, row) in enumerate(value):
+                table.append(convert(row))
+                value[num] = None # Let the dictionaries go as they are stored
+            table.pack()
+            return table
+        return value
+
+    convert(data)
+    # 'convert' refers to itself, so don't let it keep the old data around
+    converted.clear()
+    visited.clear()
+    return data
+
+def test_columns():
+    """Checks the Columns and Row views against the lists of dictionaries
+    that they stand for"""
+    from .writer import dumps
+    rows = [{"id": 1, "x": 0.5}, {"id": 2, "name": "b"}, {"id": 3, "x": 1.5}]
+    table = Columns(rows)
+    table.pack()
+    assert type(table.column("id")) is array.array
+    assert type(table.column("x")) is list # It has MISSING values
+    assert table.column("name") == [MISSING, "b", MISSING]
+    assert table == rows and table.to_list() == rows
+    assert "name" not in table[0] and table[1]["name"] == "b"
+
+    # Negative indices and slices
+    assert table[-1] == rows[-1] and table[-3] == rows[0]
+    for index in (3, -4):
+        try:
+            table[index]
+        except IndexError:
+            pass
+        else:
+            raise AssertionError("No IndexError for {}".format(index))
+    assert table[1:] == rows[1:] and table[::-2] == rows[::-2]
+    assert type(table[1:]) is Columns
+
+    # Values of the same type stay packed, others unpack the column
+    table[0]["id"] = 10
+    assert type(table.column("id")) is array.array
+    table[1]["id"] = "two"
+    assert table.column("id") == [10, "two", 3]
+    table.pack()
+    del table[2]["id"]
+    assert type(table.column("id")) is list and "id" not in table[2]
+    try:
+        del table[2]["id"]
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("Deleted a missing key")
+    table[2]["new"] = True
+    assert table.column("new") == [MISSING, MISSING, True]
+    assert len(table[2]) == 2
+
+    # Nested arrays of tables, and the writer
+    data = {"hosts": [
+        {"name": "a", "nics": [{"mtu": 1500}, {"mtu": 9000}], "sub": {"y": 1}},
+        {"name": "b", "nics": [{"mtu": 1500}], "sub": {"y": 2}},
+    ]}
+    expected = dumps(data)
+    converted = to_columns(data)
+    hosts = converted["hosts"]
+    assert type(hosts) is Columns and type(hosts[0]["nics"]) is Columns
+    assert type(hosts[1]["nics"].column("mtu")) is array.array
+    assert dumps(converted) == expected
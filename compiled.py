@@ -0,0 +1,248 @@
+# coding: utf-8
+# tomlcompiled.py
+"""
+Compiles dump functions for data that always has the same shape
+"""
+
+import datetime
+
+from .writer import TomlWriter, CircularReference, dumps, is_packed
+
+class ShapeMismatch(Exception):
+    """Raised inside compiled functions when the data doesn't have the shape
+    that they were compiled for"""
+    pass
+
+# How each simple type is written (like TomlWriter.simple_dump), as an
+# expression of the variable of the value, for a '%s'
+formatters = {
+    int: "{0}",
+    float: "{0}",
+    datetime.datetime: "{0}",
+    bool: "('1' if {0} else '0')",
+    str: "'\"' + {0}.translate(stringtrans) + '\"'",
+}
+
+def shape_of(value, ancestors=None):
+    """Returns the shape of a sample value or schema: a type, None, "list",
+    a dictionary of shapes (a table) or a list of one dictionary of shapes
+    (an array of tables)"""
+    if isinstance(value, type):
+        return "list" if value is list else value
+    if is_packed(value):
+        return type(value)
+    if value is None:
+        return None
+
+    if ancestors is None:
+        ancestors = set()
+    if id(value) in ancestors:
+        raise CircularReference("The sample contains itself")
+
+    if type(value) == dict:
+        ancestors.add(id(value))
+        shape = {key: shape_of(item, ancestors) for (key, item) in value.items()}
+        ancestors.discard(id(value))
+        return shape
+    elif type(value) == list:
+        if value and (type(value[0]) == dict):
+            ancestors.add(id(value))
+            shape = [shape_of(value[0], ancestors)]
+            ancestors.discard(id(value))
+            return shape
+        return "list"
+    return type(value)
+
+def sort_category(shape):
+    """Returns where the writer puts values of the given shape (like
+    TomlWriter.sortkey)"""
+    if (type(shape) == dict) or (shape is None):
+        return 3
+    elif type(shape) == list:
+        return 2
+    elif (shape == "list") or hasattr(shape, "tolist"):
+        return 1
+    return 0
+
+class Compiler:
+    """Writes the source of a dump function for a shape. The lines that are
+    always written together are collected into one '%' template"""
+    def __init__(self):
+        self.writer = TomlWriter() # For the headers and checking the keys
+        self.lines = []
+        self.constants = {}
+        self.names = 0
+        self.template = [] # The lines of the current template
+        self.args = [] # The expressions of its '%s'
+
+    def name(self, prefix):
+        """Returns a new variable name"""
+        self.names += 1
+        return "{}{}".format(prefix, self.names)
+
+    def constant(self, value):
+        """Returns the name of a new constant with the given value"""
+        name = self.name("c")
+        self.constants[name] = value
+        return name
+
+    def emit(self, indent, line):
+        """Adds a line of source"""
+        self.lines.append("    " * indent + line)
+
+    def output(self, text, arg=None):
+        """Adds a line of output, with 'arg' (an expression) after the text"""
+        text = text.replace("%", "%%")
+        if arg is not None:
+            text += "%s"
+            self.args.append(arg)
+        self.template.append(text)
+
+    def flush(self, indent):
+        """Adds the source that writes the current template"""
+        if not self.template:
+            return
+        template = self.constant("\n".join(self.template))
+        if self.args:
+            self.emit(indent, "append({} % ({},))".format(template, ", ".join(self.args)))
+        else:
+            self.emit(indent, "append({})".format(template))
+        self.template = []
+        self.args = []
+
+    def table(self, shape, var, indent):
+        """Adds the source that writes the table in 'var'"""
+        keys = tuple(shape)
+        self.emit(indent, "if (type({}) is not dict) or (tuple({}) != {}):".format(
+            var, var, self.constant(keys)))
+        self.emit(indent + 1, "raise ShapeMismatch()")
+
+        for key in sorted(keys, key=lambda key: sort_category(shape[key])):
+            if type(key) is not str:
+                self.writer.current = key
+                self.writer.error_key_type(key, shape)
+            self.writer.validate_context(key)
+            self.writer.current = key
+            self.value(key, shape[key], "{}[{!r}]".format(var, key), indent)
+
+    def value(self, key, shape, expression, indent):
+        """Adds the source that writes the value of the given key"""
+        v = self.name("v")
+        self.emit(indent, "{} = {}".format(v, expression))
+        if shape is None:
+            self.writer.context.append((key, "dict"))
+            self.emit(indent, "if {} is not None:".format(v))
+            self.emit(indent + 1, "raise ShapeMismatch()")
+            self.output(self.writer.get_context()[0])
+            self.writer.context.pop()
+
+        elif type(shape) == dict:
+            self.writer.context.append((key, "dict"))
+            self.output(self.writer.get_context()[0])
+            self.table(shape, v, indent)
+            self.writer.context.pop()
+
+        elif type(shape) == list:
+            # The number of elements changes, so write them separately
+            self.writer.context.append((key, "list"))
+            # (An empty one would be written with the plain values instead)
+            self.emit(indent, "if (type({0}) is not list) or (not {0}):".format(v))
+            self.emit(indent + 1, "raise ShapeMismatch()")
+            self.flush(indent)
+            item = self.name("i")
+            self.emit(indent, "for {} in {}:".format(item, v))
+            self.output(self.writer.get_context()[0])
+            self.table(shape[0], item, indent + 1)
+            self.flush(indent + 1)
+            self.writer.context.pop()
+
+        elif shape == "list":
+            self.emit(indent, "if (type({0}) is not list) or ({0} and (type({0}[0]) is dict)):".format(v))
+            self.emit(indent + 1, "raise ShapeMismatch()")
+            self.output(key + " = ", "(simple_dump({0}) if {0} else '[]')".format(v))
+
+        elif hasattr(shape, "tolist"):
+            # Packed arrays (array.array, memoryview or numpy arrays)
+            self.emit(indent, "if type({}) is not {}:".format(v, self.constant(shape)))
+            self.emit(indent + 1, "raise ShapeMismatch()")
+            self.output(key + " = ", "simple_dump({})".format(v))
+
+        elif shape in formatters:
+            self.emit(indent, "if type({}) is not {}:".format(v, self.constant(shape)))
+            self.emit(indent + 1, "raise ShapeMismatch()")
+            self.output(key + " = ", formatters[shape].format(v))
+
+        else:
+            raise Exception("Unsupported type found: '{}' for key '{}'!".format(shape, key))
+
+def compile_writer(sample_or_schema):
+    """Returns a function like 'dumps' that is faster for data with the same
+    shape as the given sample: the same keys (in the same order) and the
+    same types of values. The shape can also be given as a schema, where the
+    values are types (int, float, str, bool, datetime.datetime, list), None,
+    dictionaries or a list of one dictionary (for arrays of tables).
+    Data with any other shape is dumped by the usual writer instead"""
+    shape = shape_of(sample_or_schema)
+    if type(shape) != dict:
+        raise Exception("Only dictionaries can be compiled, not {}".format(
+            sample_or_schema))
+
+    compiler = Compiler()
+    compiler.table(shape, "data", 2)
+    compiler.flush(2)
+    source = "\n".join([
+        "def compiled_dumps(data):",
+        "    lines = []",
+        "    append = lines.append",
+        "    try:",
+    ] + compiler.lines + [
+        "    except Exception:",
+        "        # Let the usual writer dump it (or raise the right error)",
+        "        writer.active.clear()",
+        "        return dumps(data)",
+        "    return '\\n'.join(lines)",
+    ])
+
+    # Lists are dumped by a writer of their own, which only does simple_dump
+    writer = TomlWriter()
+    namespace = {
+        "dumps": dumps,
+        "ShapeMismatch": ShapeMismatch,
+        "writer": writer,
+        "simple_dump": writer.simple_dump,
+        "stringtrans": TomlWriter.stringtrans,
+    }
+    namespace.update(compiler.constants)
+    exec(compile(source, "<compiled toml writer>", "exec"), namespace)
+    function = namespace["compiled_dumps"]
+    function.source = source
+    return function
+
+def test_compile_writer():
+    """Checks that compiled functions write the same as 'dumps', also when
+    they fall back to it"""
+    sample = {"id": 1, "name": "a", "tags": ["x"], "owner": {"age": 3},
+        "nics": [{"mtu": 1500}]}
+    compiled_dumps = compile_writer(sample)
+    assert compiled_dumps(sample) == dumps(sample)
+    other = dict(sample, id="not an int")
+    assert compiled_dumps(other) == dumps(other)
+
+    # Every fallback raises a new ShapeMismatch, so that no traceback (with
+    # the data of its frames) is kept between the calls
+    import gc
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        for _ in range(1000):
+            compiled_dumps(dict(other))
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(5000):
+            compiled_dumps(dict(other))
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert growth < 64 * 1024, growth
+    assert not compiled_dumps.__globals__["writer"].active
@@ -0,0 +1,96 @@
+# coding: utf-8
+# tomlcache.py
+"""
+Saves loaded TOML files in a binary form on disk, so that later processes
+don't need to parse them again (like .pyc files)
+"""
+
+import hashlib
+import os
+import pickle
+
+# Bump this when the saved format (or what the reader returns) changes
+format_version = 4
+
+def default_directory():
+    """Returns the directory to save the cache in by default
+    ($XDG_CACHE_HOME/friendlytoml or ~/.cache/friendlytoml)"""
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "friendlytoml")
+
+class DiskCache:
+    """A cache of loaded files on disk. The cached data is used as long as the
+    mtime and size (check="stat") or the content hash (check="hash") of the
+    file are the same. With 'beside', the cache is saved in a __tomlcache__
+    directory next to each file instead of in 'directory'.
+    The cache is pickled, so only use directories that you trust"""
+    def __init__(self, directory=None, check="stat", beside=False):
+        if check not in ("stat", "hash"):
+            raise ValueError("Unknown cache check '{}' (use 'stat' or 'hash')".format(
+                check))
+        self.directory = directory
+        self.check = check
+        self.beside = beside
+
+    def cache_path(self, path):
+        """Returns where the cache of the file at the given real path is saved"""
+        if self.beside:
+            directory, name = os.path.split(path)
+            return os.path.join(directory, "__tomlcache__", name + ".pickle")
+        directory = self.directory if self.directory else default_directory()
+        name = hashlib.sha256(path.encode("utf-8")).hexdigest()
+        return os.path.join(directory, name + ".pickle")
+
+    def stamp(self, path):
+        """Returns what identifies the current version of the file"""
+        if self.check == "hash":
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            return ("hash", digest.hexdigest())
+        stat = os.stat(path)
+        return ("stat", stat.st_mtime_ns, stat.st_size)
+
+    def load(self, path, loader):
+        """Returns the cached data of the file at the given path, or loads it
+        with loader(path) and saves it in the cache"""
+        path = os.path.realpath(path)
+        stamp = self.stamp(path)
+        cache_path = self.cache_path(path)
+
+        # A broken cache file should never stop the file from loading
+        try:
+            with open(cache_path, "rb") as f:
+                version, saved_stamp, data = pickle.load(f)
+            if (version == format_version) and (saved_stamp == stamp):
+                return data
+        except Exception:
+            pass
+
+        data = loader(path)
+        temp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                pickle.dump((format_version, stamp, data), f,
+                    pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass # Just parse it again next time
+        return data
+
+    def clear(self):
+        """Removes the cached files in the cache directory (not the ones next
+        to the files)"""
+        directory = self.directory if self.directory else default_directory()
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if name.endswith(".pickle"):
+                os.remove(os.path.join(directory, name))
+
+# The cache used by 'load' with 'disk_cache=True'
+disk_cache = DiskCache()
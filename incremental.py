@@ -0,0 +1,235 @@
+# coding: utf-8
+# tomlincremental.py
+"""
+Parses a TOML document again after edits, by only parsing the tables that
+were changed
+"""
+
+import bisect
+import itertools
+
+from .reader import load_lines, tokenizers
+
+class Section:
+    """A table header and the lines after it (or the lines before the first
+    header, for the root section)"""
+    def __init__(self, start, brackets, key):
+        self.start = start # The line of the header
+        self.brackets = brackets # 1 for [table], 2 for [[array]], 0 for the root
+        self.key = key
+        self.target = None # The dictionary that the values are assigned to
+        self.keys = [] # The keys assigned by the lines of this section
+
+class IncrementalParser:
+    """Keeps a parsed TOML document up to date while its lines are edited.
+    Only the sections around an edit are tokenized again, and when their
+    headers are the same, only their values are assigned again. Edits that
+    add, remove or change a header (or whose values clash with the tables of
+    other sections) assign the values of the whole document again, so they
+    cost about as much as parsing it"""
+    def __init__(self, text, engine="regex"):
+        self.engine = engine
+        self.lines = text.split("\n")
+        self.sections = []
+        self.data = {}
+        self.broken = False # Whether the last parse failed
+        self.build()
+
+    def scan(self, start):
+        """Yields (line_num, brackets, key) for each header from the given
+        line, which must not be inside a string or array"""
+        lines = itertools.islice(self.lines, start, None)
+        for (line_num, line) in tokenizers[self.engine](lines, start):
+            first = line[0][0]
+            if ((first == "[") or (first == "[[")) and (len(line) > 1):
+                yield (line_num, len(first), line[1][0])
+
+    def end_of(self, num):
+        """Returns the line after the last line of the given section"""
+        if num + 1 < len(self.sections):
+            return self.sections[num + 1].start
+        return len(self.lines)
+
+    def build(self):
+        """Parses the whole document"""
+        self.broken = True
+        self.sections = [Section(0, 0, None)]
+        for (line_num, brackets, key) in self.scan(0):
+            self.sections.append(Section(line_num, brackets, key))
+        self.rebuild()
+
+    def rebuild(self):
+        """Assigns the values of every section again"""
+        self.broken = True
+        self.data = {}
+        for num in range(len(self.sections)):
+            self.parse_header(num)
+            self.parse_body(num)
+        self.broken = False
+
+    def parse_header(self, num):
+        """Creates the table of the given section, and finds its dictionary"""
+        section = self.sections[num]
+        section.keys = []
+        if not section.brackets:
+            section.target = self.data
+            return
+
+        load_lines([self.lines[section.start]], self.engine, self.data,
+            section.start)
+        target = self.data
+        for part in section.key.split("."):
+            if type(target) == list:
+                target = target[-1]
+            target = target[part]
+        if type(target) == list:
+            target = target[-1]
+        section.target = target
+
+    def parse_body(self, num):
+        """Assigns the values of the given section again"""
+        section = self.sections[num]
+        start = section.start + 1 if section.brackets else section.start
+        values = load_lines(self.lines[start:self.end_of(num)], self.engine,
+            None, start)
+
+        target = section.target
+        for key in values:
+            if (key in target) and (key not in section.keys):
+                raise Exception("Duplicate key found: '{}' in section starting on line {}".format(
+                    key, section.start))
+        for key in section.keys:
+            del target[key]
+        target.update(values)
+        section.keys = list(values)
+
+    def detached(self):
+        """Returns whether the dictionary of a section is no longer in the data
+        (because a later header or value replaced it, like empty tables can
+        be)"""
+        found = set()
+        tables = [self.data]
+        while tables:
+            table = tables.pop()
+            found.add(id(table))
+            for value in table.values():
+                if type(value) == dict:
+                    tables.append(value)
+                elif (type(value) == list) and value and (type(value[0]) == dict):
+                    tables.extend(value)
+        return any(id(section.target) not in found for section in self.sections)
+
+    def edit(self, start, end, text):
+        """Replaces the lines from 'start' up to (not including) 'end' with the
+        given text (a string or a list of lines), and returns the updated
+        data"""
+        new_lines = text.split("\n") if type(text) == str else list(text)
+        self.lines[start:end] = new_lines
+        delta = len(new_lines) - (end - start)
+
+        if self.broken:
+            self.build()
+            return self.data
+
+        try:
+            self.update(start, start + len(new_lines), delta)
+        except Exception:
+            self.broken = True
+            raise
+        return self.data
+
+    def update(self, start, edit_end, delta):
+        """Parses the sections around the edited lines again"""
+        starts = [section.start for section in self.sections]
+        first = bisect.bisect_right(starts, start) - 1
+        if (first > 0) and (starts[first] == start):
+            # Lines inserted before a header might belong to the section above
+            first -= 1
+
+        # Find the headers until they line up with the old ones again
+        headers = []
+        resync = len(self.sections)
+        for (line_num, brackets, key) in self.scan(starts[first]):
+            if line_num >= edit_end:
+                old = bisect.bisect_left(starts, line_num - delta)
+                if (old > first) and (old < len(starts)) and (
+                        starts[old] == line_num - delta):
+                    resync = old
+                    break
+            headers.append((line_num, brackets, key))
+
+        old_sections = self.sections[first:resync]
+        if first == 0:
+            headers.insert(0, (0, 0, None))
+        for section in self.sections[resync:]:
+            section.start += delta
+
+        same = (len(headers) == len(old_sections)) and all(
+            (section.brackets, section.key) == (brackets, key)
+            for (section, (_, brackets, key)) in zip(old_sections, headers))
+
+        if same:
+            # Only the values changed, so the tables can be kept
+            for (section, (line_num, _, _)) in zip(old_sections, headers):
+                section.start = line_num
+            try:
+                for num in range(first, resync):
+                    self.parse_body(num)
+                clash = self.detached()
+            except Exception:
+                clash = True
+            if clash:
+                # Whether the values are allowed (or where they end up) depends
+                # on the other sections, so parse them all like 'loads' does
+                self.rebuild()
+        else:
+            self.sections[first:resync] = [Section(line_num, brackets, key)
+                for (line_num, brackets, key) in headers]
+            self.rebuild()
+
+def test_edits():
+    """Checks that the data after each edit (or the error) is the same as
+    what 'loads' returns for the edited text"""
+    from .reader import loads
+    doc = "\n".join([
+        "title = \"x\"",
+        "[ in ]",
+        "# [ in ]",
+        "[ other ]",
+        "z = 3",
+        "[[ arr ]]",
+        "v = 1",
+        "[ x ]",
+        "a = 0",
+        "[ x.a ]",
+    ])
+    edits = [
+        (4, 5, "z = 4"), # Only a value
+        (2, 3, "[ in ]"), # A comment becomes a second (empty) table
+        (2, 2, "q = 1"), # A value in the first of them, which is an error
+        (2, 3, ""), # Fixed again
+        (9, 9, "[ in ]\nw = 2"), # A header after a table with values
+        (9, 11, ""),
+        (8, 9, "a = 1"), # The value that the [ x.a ] table replaced
+        (8, 9, "a = 0"),
+        (9, 9, "b = 2"), # Another value next to it
+        (7, 7, "v = 2"), # A value in an array of tables
+        (5, 5, "[[ arr ]]\nv = 0"),
+        (1, 2, "[ other ]"), # A header that was already there
+        (1, 2, "[ in2 ]"),
+    ]
+    parser = IncrementalParser(doc)
+    lines = doc.split("\n")
+    assert parser.data == loads(doc)
+    for (start, end, text) in edits:
+        lines[start:end] = text.split("\n")
+        try:
+            expected = loads("\n".join(lines))
+        except Exception as e:
+            expected = str(e)
+        try:
+            result = parser.edit(start, end, text)
+        except Exception as e:
+            result = str(e)
+        assert result == expected, (start, end, text, result, expected)
+        assert parser.lines == lines
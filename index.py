@@ -0,0 +1,167 @@
+# coding: utf-8
+# tomlindex.py
+"""
+Keeps an index of where each table starts in a TOML file, so that single
+values can be looked up without parsing the whole file
+"""
+
+import bisect
+import marshal
+import os
+import re
+
+from .reader import scan_headers, parse_section
+
+# Parts of a path like 'servers.alpha' or 'friends[3].name'
+_path_part = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+def split_path(path):
+    """Splits the given path into a list of (key, index) parts, where one of
+    them is None"""
+    parts = []
+    for match in _path_part.finditer(path):
+        key, index = match.groups()
+        parts.append((key, None if index is None else int(index)))
+    return parts
+
+class TableIndex:
+    """An index of the byte offset and line number of each table in a TOML
+    file, which is saved next to the file and rebuilt when the file changes"""
+    version = 1
+
+    def __init__(self, path, index_path=None, engine="regex"):
+        self.path = path
+        self.index_path = index_path if index_path else path + ".index"
+        self.engine = engine
+        self.size = None
+        self.mtime_ns = None
+        self.tables = {} # table path: (start, end, line_num)
+        self.paths = [] # The table paths in sorted order
+        if not self.read():
+            self.build()
+            self.write()
+
+    def is_stale(self):
+        """Returns whether the file has changed since the index was built"""
+        stat = os.stat(self.path)
+        return (stat.st_size != self.size) or (stat.st_mtime_ns != self.mtime_ns)
+
+    def read(self):
+        """Reads the saved index, and returns whether it is usable"""
+        try:
+            with open(self.index_path, "rb") as f:
+                saved = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+
+        if (type(saved) != dict) or (saved.get("version") != self.version):
+            return False
+        self.size = saved["size"]
+        self.mtime_ns = saved["mtime_ns"]
+        self.tables = saved["tables"]
+        self.paths = sorted(self.tables)
+        return not self.is_stale()
+
+    def write(self):
+        """Saves the index next to the file (if possible)"""
+        saved = {
+            "version": self.version,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "tables": self.tables
+        }
+        temp_path = self.index_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                marshal.dump(saved, f)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            pass # The index still works in memory
+
+    def build(self):
+        """Finds where each table in the file starts"""
+        stat = os.stat(self.path)
+        with open(self.path, "rb") as f:
+            headers = list(scan_headers(f, self.engine))
+
+        # The keys before the first table
+        tables = {"": (0, headers[0][2] if headers else None, 0)}
+        arrays = {} # array path: number of tables in it
+        for num, (key, brackets, offset, line_num) in enumerate(headers):
+            end = headers[num + 1][2] if num + 1 < len(headers) else None
+
+            # Refer to the latest table of the arrays on the way
+            parts = key.split(".")
+            path = ""
+            for part in parts[:-1]:
+                path = path + "." + part if path else part
+                if path in arrays:
+                    path += "[{}]".format(arrays[path] - 1)
+            path = path + "." + parts[-1] if path else parts[-1]
+
+            if brackets == 2:
+                count = arrays.get(path, 0)
+                arrays[path] = count + 1
+                path += "[{}]".format(count)
+
+            tables[path] = (offset, end, line_num)
+
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.tables = tables
+        self.paths = sorted(tables)
+
+    def sections_under(self, path):
+        """Returns the sections of the given table and the tables inside it"""
+        sections = []
+        if path in self.tables:
+            sections.append(self.tables[path])
+        for prefix in (path + ".", path + "["):
+            num = bisect.bisect_left(self.paths, prefix)
+            while (num < len(self.paths)) and self.paths[num].startswith(prefix):
+                sections.append(self.tables[self.paths[num]])
+                num += 1
+        return sections
+
+    def get(self, path):
+        """Returns the value at the given path, like 'servers.alpha.ip' or
+        'friends[3]', by parsing only the tables it is in"""
+        if self.is_stale():
+            self.build()
+            self.write()
+
+        # Either the path is a table, or it is a key in the closest table
+        table = path
+        sections = self.sections_under(path)
+        if not sections:
+            table = ""
+            for match in reversed(list(re.finditer(r"[.\[]", path))):
+                if path[:match.start()] in self.tables:
+                    table = path[:match.start()]
+                    break
+            sections = [self.tables[table]]
+
+        data = {}
+        for (start, end, line_num) in sorted(sections):
+            parse_section(self.path, start, end, line_num, data, self.engine)
+
+        # Only the indexed array tables were parsed, so use the latest one
+        table_parts = len(split_path(table))
+        value = data
+        for num, (key, index) in enumerate(split_path(path)):
+            try:
+                if key is not None:
+                    value = value[key]
+                elif num < table_parts:
+                    if type(value) == list:
+                        value = value[-1]
+                else:
+                    value = value[index]
+            except (KeyError, IndexError, TypeError):
+                raise KeyError(path)
+        return value
+
+def get(path, key, engine="regex"):
+    """Returns the value at the given key path (like 'servers.alpha.ip') in the
+    TOML file at the given path, using (or creating) the index next to it"""
+    return TableIndex(path, engine=engine).get(key)
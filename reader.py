@@ -2,9 +2,25 @@
 # Created January 8th 2015
 # tomlreader.py
 
+import array
+import collections
+import collections.abc
 import datetime
+import functools
+import io
+import mmap as mmap_module
+import os
+import re
+import sys
+import threading
+import time
+import types
+import warnings
 
-def tokenize(iterable):
+from . import diskcache
+from .columns import Columns, to_columns
+
+def tokenize(iterable, first_line=0):
     """Tokenize the shit out of those lines.
     Yields tuples of (line_start, [(token, offset), ..]) """
     # global
@@ -17,7 +33,7 @@ def tokenize(iterable):
     escaped_line = False
     triple_content = False
     array_nesting = 0
-    line_start = 0 # At which line the returned tokens start
+    line_start = first_line # At which line the returned tokens start
     _escaped_chars = {
         "b": "\b", 
         "t": "\t",
@@ -36,7 +52,7 @@ def tokenize(iterable):
             line_tokens.append((token, start))
             current.clear()
     
-    for line_num, line in enumerate(iterable):
+    for line_num, line in enumerate(iterable, first_line):
         #print(line)
         assignment = False
         started = None
@@ -359,17 +375,676 @@ def tokenize(iterable):
     if line_tokens:
         yield (line_start, line_tokens)
 
+# Patterns for the regex tokenizer. Each one matches the rest of a bare token
+# (key, number, datetime, etc.) and stops at the chars that end a token in
+# the given scope
+_whitespace = re.compile(r"\s*")
+_key_chars = re.compile(r"[^\s#=]*")
+_header_chars = re.compile(r"[^\s#=\]]*")
+_value_chars = re.compile(r"[^\s#=\[\"']*")
+_header_value_chars = re.compile(r"[^\s#=\[\]\"']*")
+_element_chars = re.compile(r"[^\s#\[\],\"']*")
+# Matches string content up to the next char that needs a closer look
+_string_chars = {
+    '"': re.compile(r'[^"\\]*'),
+    "'": re.compile(r"[^']*")
+}
+# Whole lines of the most common shapes, so that they can be matched in one go
+_assignment_line = re.compile(
+    r"\s*([^\s#=\[\"']+)\s*(=)\s*"
+    r"([^\s#=\[\"']+|\"[^\"\\]*\"|'[^']*')\s*(#.*)?$")
+_table_line = re.compile(r"\s*(\[\[|\[(?!\[))\s*([^\s#=\]]+)\s*(\]\]?)\s*(#.*)?$")
+# The same for lines in bytes. They only match like the str patterns on lines
+# of printable ASCII (and tabs), as bytes' \s is only ASCII whitespace
+_assignment_bytes = re.compile(_assignment_line.pattern.encode())
+_table_bytes = re.compile(_table_line.pattern.encode())
+_unusual_bytes = re.compile(rb"[^\t\x20-\x7e]")
+# The next bracket, element or simple string in an array
+_array_token = re.compile(
+    r"[\s,]*(?:([\[\]])|([^\s#\[\],\"']+)"
+    r"|(\"(?!\"\")[^\"\\]*\"|'(?!'')[^']*'))")
+_escaped_chars = {
+    "b": "\b",
+    "t": "\t",
+    "n": "\n",
+    "f": "\f",
+    "r": "\r",
+    "/": "/",
+    "\\": "\\"
+}
+
+def tokenize_regex(iterable, first_line=0, buffer=None):
+    """Tokenizes the lines like 'tokenize', but matches whole tokens with
+    precompiled regular expressions instead of walking every character.
+    If a buffer of UTF-8 bytes (like an mmap) is given, the iterable yields the
+    (start, end) offsets of its lines instead (see 'buffer_lines'). The most
+    common lines of printable ASCII are then matched in the buffer itself, so
+    that only their tokens are decoded.
+    Yields tuples of (line_start, [(token, offset), ..]) """
+    current = [] # The parts of the string being read
+    line_tokens = []
+    string_container = None # The quote char while inside a string
+    triple_quoted = False
+    triple_content = False
+    escaped = False
+    escaped_line = False
+    array_nesting = 0
+    line_start = first_line
+    start = 0
+
+    for line_num, line in enumerate(iterable, first_line):
+        started = False
+        assignment = False
+        identifier = 0
+        offset = 0
+
+        # Same line handling as 'tokenize'
+        if escaped:
+            escaped_line = True
+        elif triple_quoted:
+            if triple_content:
+                current.append("\n")
+            else:
+                triple_content = True
+        elif line_tokens and (not array_nesting):
+            yield (line_start, line_tokens)
+            line_tokens = []
+            line_start = line_num
+        elif not (string_container or array_nesting):
+            line_start = line_num
+
+        # Try to match the whole line at once. Lines of printable ASCII are
+        # matched in the buffer itself, and the others are decoded first
+        whole_line = not (string_container or array_nesting)
+        if buffer is not None:
+            line_begin, line_end = line
+            if whole_line and (_unusual_bytes.search(
+                    buffer, line_begin, line_end) is None):
+                whole_line = False # Don't try the str patterns again
+                match = _assignment_bytes.match(buffer, line_begin, line_end)
+                if match is None:
+                    match = _table_bytes.match(buffer, line_begin, line_end)
+                    if match and (len(match.group(1)) != len(match.group(3))):
+                        match = None
+                if match:
+                    for group in (1, 2, 3, 4):
+                        token = match.group(group)
+                        if token is not None:
+                            line_tokens.append((token.decode("utf-8"),
+                                match.start(group) - line_begin))
+                    continue
+            line = buffer[line_begin:line_end].decode("utf-8")
+
+        if whole_line:
+            match = _assignment_line.match(line)
+            if match is None:
+                match = _table_line.match(line)
+                # Make sure that the brackets match
+                if match and (len(match.group(1)) != len(match.group(3))):
+                    match = None
+            if match:
+                for group in (1, 2, 3, 4):
+                    token = match.group(group)
+                    if token is not None:
+                        line_tokens.append((token, match.start(group)))
+                continue
+
+        line_length = len(line)
+
+        while offset < line_length:
+            # Inside a string
+            if string_container:
+                if escaped:
+                    # Ignore whitespace after the escape char
+                    offset = _whitespace.match(line, offset).end()
+                    if offset == line_length:
+                        break
+                    char = line[offset]
+
+                    # It's a line escape
+                    if escaped_line:
+                        escaped_line = False
+                        if (char == string_container) and ((not triple_quoted)
+                                or line.startswith(char * 3, offset)):
+                            escaped = False
+                            # Close the string below
+
+                        # Another escape char, so escape what comes next
+                        elif char == "\\":
+                            offset += 1
+                            continue
+
+                        else:
+                            escaped = False
+                            current.append(char)
+                            offset += 1
+                            continue
+
+                    else:
+                        if char == "u":
+                            raise Exception("Escaped unicode == NOT supported!")
+                        current.append(_escaped_chars.get(char, char))
+                        escaped = False
+                        offset += 1
+                        continue
+
+                else:
+                    if triple_quoted:
+                        triple_content = True
+
+                    # Read until a quote or an escape char
+                    match = _string_chars[string_container].match(line, offset)
+                    current.append(match.group())
+                    offset = match.end()
+                    if offset == line_length:
+                        break
+                    char = line[offset]
+
+                    if char == "\\":
+                        escaped = True
+                        offset += 1
+                        continue
+
+                    # Just a quote inside a multiline string
+                    if triple_quoted and (not line.startswith(char * 3, offset)):
+                        current.append(char)
+                        offset += 1
+                        continue
+
+                # The string ends
+                current.append(string_container)
+                line_tokens.append(("".join(current), start))
+                current = []
+                offset += 3 if triple_quoted else 1
+                string_container = None
+                triple_quoted = False
+                continue
+
+            # Read array elements until something needs a closer look
+            if array_nesting:
+                append = line_tokens.append
+                for match in iter(_array_token.scanner(line, offset).match, None):
+                    group = match.lastindex
+                    token = match.group(group)
+                    append((token, match.start(group)))
+                    offset = match.end()
+                    if group == 1:
+                        if token == "[":
+                            array_nesting += 1
+                        else:
+                            array_nesting -= 1
+                            if not array_nesting:
+                                break
+
+            offset = _whitespace.match(line, offset).end()
+            if offset == line_length:
+                break
+            char = line[offset]
+            start = offset
+
+            # Comments take the rest of the line
+            if char == "#":
+                line_tokens.append((line[offset:], offset))
+                break
+
+            # Array scope
+            elif array_nesting:
+                if (char == '"') or (char == "'"):
+                    pass # Start the string below
+
+                elif char == "[" or char == "]":
+                    line_tokens.append((char, offset))
+                    offset += 1
+                    if char == "[":
+                        array_nesting += 1
+                    else:
+                        array_nesting -= 1
+                    continue
+
+                elif char == ",":
+                    offset += 1
+                    continue
+
+                else:
+                    end = _element_chars.match(line, offset).end()
+                    line_tokens.append((line[offset:end], offset))
+                    offset = end
+                    continue
+
+            # If the line content hasn't started yet
+            elif not started:
+                started = True
+                if char == "[":
+                    if line.startswith("[[", offset):
+                        line_tokens.append(("[[", offset))
+                        identifier = 2
+                    else:
+                        line_tokens.append(("[", offset))
+                        identifier = 1
+                    offset += identifier
+
+                else:
+                    end = _key_chars.match(line, offset + 1).end()
+                    line_tokens.append((line[offset:end], offset))
+                    offset = end
+                continue
+
+            # The line has started
+            elif char == "=":
+                line_tokens.append((char, offset))
+                assignment = True
+                offset += 1
+                continue
+
+            elif assignment and (char == "["):
+                line_tokens.append((char, offset))
+                array_nesting += 1
+                offset += 1
+                continue
+
+            elif identifier and (char == "]"):
+                if (identifier == 2) and line.startswith("]]", offset):
+                    token = "]]"
+                else:
+                    token = "]"
+                line_tokens.append((token, offset))
+                offset += len(token)
+                identifier = 0
+                continue
+
+            elif not (assignment and (char == '"' or char == "'")):
+                if assignment:
+                    pattern = _header_value_chars if identifier else _value_chars
+                else:
+                    pattern = _header_chars if identifier else _key_chars
+                end = pattern.match(line, offset + 1).end()
+                line_tokens.append((line[offset:end], offset))
+                offset = end
+                continue
+
+            # A string starts
+            string_container = char
+            current = [char]
+            if line.startswith(char * 3, offset):
+                triple_quoted = True
+                triple_content = False
+                offset += 3
+            else:
+                offset += 1
+
+        # Get the remainder of an unfinished single-line string
+        if (not (triple_quoted or escaped)) and current:
+            line_tokens.append(("".join(current), start))
+            current = []
+
+    if line_tokens:
+        yield (line_start, line_tokens)
+
+# The available tokenizer engines
+tokenizers = {
+    "loop": tokenize,
+    "regex": tokenize_regex
+}
+
+# How many of the most recent source lines to keep for error messages
+error_window = 100
+
+def buffer_lines(buffer):
+    """Yields the (start, end) offsets of the lines in the given buffer of bytes,
+    without their line endings"""
+    start = 0
+    size = len(buffer)
+    while start < size:
+        end = buffer.find(b"\n", start)
+        if end == -1:
+            end = size
+        next_start = end + 1
+        if (end > start) and (buffer[end - 1] == ord("\r")):
+            end -= 1
+        yield (start, end)
+        start = next_start
+
+def decoded_lines(iterable, buffer):
+    """Yields the text of the (start, end) offsets of lines in the buffer"""
+    for (start, end) in iterable:
+        yield buffer[start:end].decode("utf-8")
+
+def recent_lines(iterable, window, first_line=0, strip=True):
+    """Yields the lines of the iterable without their line endings, and keeps
+    the most recent ones as (line_num, line) in the given deque"""
+    for line_num, line in enumerate(iterable, first_line):
+        if strip and line.endswith("\n"):
+            line = line[:-1]
+        window.append((line_num, line))
+        yield line
+
+illegal_key_chars = {
+    "=", ".", "#", "[", "]"
+}
+
+def raise_error(msg):
+    """Raises an exception with the given message"""
+    raise Exception(msg)
+
+def source_line(window, num, buffer=None):
+    """Returns the given source line, if it is still in the window.
+    If a buffer is given, the window holds (start, end) offsets into it"""
+    for (window_num, line) in window:
+        if window_num == num:
+            if buffer is not None:
+                start, end = line
+                return buffer[start:end].decode("utf-8", "replace")
+            return line
+    return "(line no longer available)"
+
+def validate(key, error_token=raise_error):
+    """Ensures that the given key token is valid"""
+    invalid = set()
+    for char in key:
+        if char.isspace():
+            invalid.add(char)
+        elif char in illegal_key_chars:
+            invalid.add(char)
+
+    if invalid:
+        error_token("Invalid characters ({}) found in key".format(
+            ", ".join(["'{}'".format(c) for c in invalid])
+        ))
+
+# Offset ("+05:30"): timezone, so that each offset only gets one object
+timezones = {}
+
+def strptime_datetime(token):
+    """Parses a datetime with strptime, or returns None if it is invalid"""
+    fmt = "%Y-%m-%dT%H:%M:%S"
+    value = token
+
+    # Partial seconds
+    if "." in value:
+       fmt += ".%f"
+
+    # No timezone difference
+    if value.endswith("Z"):
+       fmt += "Z"
+    # Timezone difference
+    else:
+       # Remove the ':' in the RFC format
+       value = value[:-3] + value[-2:]
+       fmt += "%z"
+
+    try:
+       return datetime.datetime.strptime(value, fmt)
+    except Exception as e:
+       return None
+
+# YYYY-MM-DDTHH:MM:SS[.ffffff](Z|+HH:MM), matched as fixed-width fields
+_datetime_token = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(Z|[+-]\d\d:[0-5]\d)\Z",
+    re.ASCII)
+
+def datetime_from_token(token):
+    """Parses a datetime token, or returns None if it is invalid.
+    The usual RFC 3339 form is converted directly, and everything else goes
+    through strptime (so the results are the same)"""
+    match = _datetime_token.match(token)
+    if match is None:
+        return strptime_datetime(token)
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+
+    # 'Z' gives a datetime without a timezone, like strptime does
+    tz = None
+    if offset != "Z":
+        tz = timezones.get(offset)
+        if tz is None:
+            delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[4:]))
+            try:
+                tz = datetime.timezone(-delta if offset[0] == "-" else delta)
+            except ValueError:
+                return strptime_datetime(token)
+            timezones[offset] = tz
+
+    try:
+        return datetime.datetime(int(year), int(month), int(day), int(hour),
+            int(minute), int(second), int(fraction.ljust(6, "0")) if fraction else 0,
+            tz)
+    except ValueError:
+        return strptime_datetime(token) # Like leap seconds
+
+# What 'interpret' uses to parse datetimes (see 'memoize_datetimes')
+parse_datetime = datetime_from_token
+
+def memoize_datetimes(max_entries=4096):
+    """Makes 'interpret' reuse the datetimes of the most recently parsed
+    datetime strings (up to 'max_entries' of them), which helps with files
+    where the same timestamps are repeated. 0 turns it off again"""
+    global parse_datetime
+    if max_entries:
+        parse_datetime = functools.lru_cache(max_entries)(datetime_from_token)
+    else:
+        parse_datetime = datetime_from_token
+
+def interpret(token, error_token=raise_error):
+    """Interprets the given token as an internal value"""
+    # String (the tokenizer handles escapes)
+    if token.startswith(("'", '"')):
+        return token[1:-1]
+
+    # Number or datetime            
+    elif token[0].isnumeric() or token.startswith(("-", "+")):
+        if len(token) > 4:
+            # Datetime format
+            if token[4] == "-": # 1994-02-20 etc.
+                # YYYY-MM-DDTHH:MM:SS-Offset
+                # 1996-12-19T16:39:57-08:00
+                # 1990-12-31T15:59:60-08:00
+                value = parse_datetime(token)
+                if value is None:
+                   error_token("Invalid datetime '{}'".format(token))
+                return value
+
+        # Float
+        if "." in token:
+            try:
+                return float(token)
+            except ValueError as e:
+                error_token("Invalid float value '{}'".format(token))
+
+        # Int
+        else:
+            try:
+                return int(token)
+            except ValueError as e:
+                error_token("Invalid integer value '{}'".format(token))
+
+    # Something else?
+    else:
+        error_token("Unknown value in assignment")
+
+def keep_token(token, error_token=raise_error):
+    """Returns the token as it is (to interpret it later)"""
+    return token
+
+def import_numpy():
+    """Returns the numpy module, which is only needed for array_mode="numpy" """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("array_mode=\"numpy\" needs numpy to be installed")
+    return numpy
 
+def is_float_token(token):
+    """Returns whether 'interpret' reads the given element token as a float:
+    it has a '.', starts like a number and doesn't look like a datetime
+    (so '.5' and '1.5e-10' aren't floats)"""
+    if type(token) != str:
+        return False
+    if not (token[0].isnumeric() or token.startswith(("-", "+"))):
+        return False
+    if (len(token) > 4) and (token[4] == "-"):
+        return False
+    return "." in token
 
-def loads(string):
-    """Loads a dictionary from the given string"""
-    data = {}
-    lines = string.split("\n")
-    scope = []
+def pack_numbers(tokens):
+    """Returns an array.array of the given element tokens if they are all ints
+    ('q') or all floats ('d'), or None if they aren't"""
+    if not tokens:
+        return None
+    try:
+        return array.array("q", map(int, tokens))
+    except (ValueError, OverflowError, TypeError):
+        pass
+    if all(map(is_float_token, tokens)):
+        try:
+            return array.array("d", map(float, tokens))
+        except (ValueError, TypeError):
+            pass
+    return None
+
+def flatten_tokens(tokens, shape, depth, flat):
+    """Adds the tokens of a nested array to 'flat' if it has the given shape,
+    and returns whether it had"""
+    if len(tokens) != shape[depth]:
+        return False
+    if depth + 1 == len(shape):
+        for token in tokens:
+            if type(token) == list:
+                return False
+        flat.extend(tokens)
+        return True
+    for token in tokens:
+        if (type(token) != list) or not flatten_tokens(token, shape, depth + 1, flat):
+            return False
+    return True
+
+def pack_ndarray(tokens):
+    """Returns a numpy array of the given (nested) element tokens if the array
+    is rectangular and all of its elements are ints or all floats, or None"""
+    shape = []
+    level = tokens
+    while type(level) == list:
+        if not level:
+            return None
+        shape.append(len(level))
+        level = level[0]
+
+    flat = []
+    if not flatten_tokens(tokens, shape, 0, flat):
+        return None
+    numbers = pack_numbers(flat)
+    if numbers is None:
+        return None
+    numpy = import_numpy()
+    dtype = numpy.int64 if numbers.typecode == "q" else numpy.float64
+    return numpy.frombuffer(numbers, dtype).reshape(shape)
+
+def pack_array(tokens, array_mode, error_token=raise_error):
+    """Converts an array of element tokens (with lists for nested arrays) into
+    an array.array (array_mode="array") or numpy array ("numpy") if all of its
+    elements are ints or all floats. Other arrays become lists of their
+    interpreted elements, with their nested arrays packed the same way"""
+    if array_mode == "numpy":
+        packed = pack_ndarray(tokens)
+    else:
+        packed = pack_numbers(tokens)
+    if packed is not None:
+        return packed
+
+    values = []
+    for token in tokens:
+        if type(token) == list:
+            values.append(pack_array(token, array_mode, error_token))
+        else:
+            # The error points at the end of the array, so name the token
+            values.append(interpret(token,
+                lambda msg: error_token("{} '{}'".format(msg, token))))
+    return values
+
+def loads(string, engine="regex", stats=None, array_mode="list",
+        resolve_refs=False, dedupe=False, array_tables="list"):
+    """Loads a dictionary from the given string.
+    'engine' selects the tokenizer (see 'tokenizers'), and timings and
+    counters are added to 'stats' (a Stats) if it is given.
+    With array_mode="array" or "numpy", arrays of only ints or only floats
+    are loaded as array.array or (N-dimensional) numpy arrays instead of
+    lists, which is faster and takes less memory.
+    With 'resolve_refs', the '#@id=' and '#@ref=' comments of the writer
+    (with refs=True) are used to load shared tables and arrays as the same
+    objects again, so that shared and recursive data can be loaded back.
+    With 'dedupe', identical leaf tables and arrays are loaded as one shared
+    read-only object (see 'dedupe_data'), which saves memory for documents
+    that repeat them a lot.
+    With array_tables="columns", arrays of tables are loaded as Columns,
+    which store a list of values per key instead of a dictionary per table"""
+    return load_lines(string.split("\n"), engine, stats=stats,
+        array_mode=array_mode, resolve_refs=resolve_refs, dedupe=dedupe,
+        array_tables=array_tables)
+
+def load_lines(iterable, engine="regex", data=None, first_line=0, buffer=None,
+        stats=None, array_mode="list", resolve_refs=False, dedupe=False,
+        array_tables="list"):
+    """Loads a dictionary from an iterable of lines (like an open file).
+    The lines are parsed as they are read, so only a few of them are in
+    memory at a time. If 'data' is given, the tables are added to it, and
+    'first_line' is the line number of the first line (for error messages).
+    If a buffer is given, the lines are (start, end) offsets into it"""
+    if array_tables not in ("list", "columns"):
+        raise ValueError("Unknown array_tables '{}' (use 'list' or 'columns')".format(
+            array_tables))
+    if data is None:
+        data = {}
+    if stats is not None:
+        start = time.perf_counter()
+    for _ in parse_steps(iterable, engine, data, first_line, buffer, stats=stats,
+            array_mode=array_mode, resolve_refs=resolve_refs):
+        pass
+    if array_tables == "columns":
+        to_columns(data)
+    if dedupe:
+        dedupe_data(data)
+    if stats is not None:
+        stats.add_time("load", time.perf_counter() - start)
+    return data
+
+def parse_steps(iterable, engine, data, first_line=0, buffer=None, step=None,
+        stats=None, array_mode="list", resolve_refs=False):
+    """Parses the lines into the given data like 'load_lines', but yields
+    (None) after every 'step' statements, so that the parsing can be paused"""
+    if array_mode not in ("list", "array", "numpy"):
+        raise ValueError("Unknown array_mode '{}' (use 'list', 'array' or 'numpy')".format(
+            array_mode))
+    if array_mode == "numpy":
+        import_numpy() # Complain before parsing anything
+    next_pause = step
+    window = collections.deque(maxlen=error_window)
+    if (buffer is not None) and (engine != "regex"):
+        # Only the regex engine matches in the buffer, so decode the lines
+        iterable = decoded_lines(iterable, buffer)
+        buffer = None
+    if buffer is None:
+        lines = recent_lines(iterable, window, first_line)
+        tokens = tokenizers[engine](lines, first_line)
+    else:
+        lines = recent_lines(iterable, window, first_line, strip=False)
+        tokens = tokenize_regex(lines, first_line, buffer)
+    scope = ()
+    
+    # Path: table (or array of tables), so that tables don't need to be found
+    # by walking from the root every time. The tables inside an array of
+    # tables are forgotten when it gets a new element, so 'owners' keeps the
+    # closest array of tables of each path (or None), and 'nested' the paths
+    # found inside the current element of each array
+    tables = {(): data}
+    owners = {(): None}
+    nested = {}
+    intern = sys.intern
     
     var = {}
     var["last_scope"] = scope
     var["last_target"] = data
+    var["list_id"] = None # The '#@list-id=' for the next array of tables
+    objects = {} # The tables and arrays of the '#@id=' comments
+    var["warned"] = False # Whether unresolved references were found
+    list_ids = set() # The ids of the arrays of tables, when not resolving
     replacements = {
         "b": "\b", 
         "t": "\t",
@@ -379,88 +1054,64 @@ def loads(string):
         "/": "/", 
         "\\": "\\"
     }
-    illegal_key_chars = {
-        "=", ".", "#", "[", "]"
-    }
     
     def error_token(msg): # , line_num, offset
         """Raises an exception with some debug info :)"""
         arrmsg = " in array starting" if array_depth else ""
         message = msg + arrmsg + " on line {}:\n{}\n{}".format(
-            line_num, lines[line_num], "~" * offset + "^")
+            line_num, source_line(window, line_num, buffer), "~" * offset + "^")
         raise Exception(message)
     
-    def validate(key):
-        """Ensures that the given key token is valid"""
-        invalid = set()
-        for char in key:
-            if char.isspace():
-                invalid.add(char)
-            elif char in illegal_key_chars:
-                invalid.add(char)
-        
-        if invalid:
-            error_token("Invalid characters ({}) found in key".format(
-                ", ".join(["'{}'".format(c) for c in invalid])
-            ))
-    
-    def interpret(token):
-        """Interprets the given token as an internal value"""
-        # String (the tokenizer handles escapes)
-        if token.startswith(("'", '"')):
-            return token[1:-1]
-        
-        # Number or datetime            
-        elif token[0].isnumeric() or token.startswith(("-", "+")):
-            if len(token) > 4:
-                # Datetime format
-                if token[4] == "-": # 1994-02-20 etc.
-                    fmt = "%Y-%m-%dT%H:%M:%S"
-                    value = token
-                                
-                    # Partial seconds
-                    if "." in value:
-                       fmt += ".%f"
-
-                    # No timezone difference
-                    if value.endswith("Z"):
-                       fmt += "Z"
-                    # Timezone difference
-                    else:
-                       # Remove the ':' in the RFC format
-                       value = value[:-3] + value[-2:]
-                       fmt += "%z"
-
-                    # YYYY-MM-DDTHH:MM:SS-Offset
-                    # 1996-12-19T16:39:57-08:00
-                    # 1990-12-31T15:59:60-08:00
-                    try:
-                       return datetime.datetime.strptime(value, fmt)
-                    except Exception as e:
-                       error_token("Invalid datetime '{}'".format(token))
+    def resolve(path):
+        """Returns the table or array of tables at the given path (a tuple),
+        and creates the missing tables on the way"""
+        target = tables.get(path)
+        if target is None:
+            target = resolve(path[:-1])
+            if type(target) == list:
+                # Get the last element then
+                target = target[-1]
             
-            # Float
-            if "." in token:
-                try:
-                    return float(token)
-                except ValueError as e:
-                    error_token("Invalid float value '{}'".format(token))
+            key = path[-1]
+            found = target.get(key, None)
+            # Create intermediate dictionaries
+            if found is None:
+                # Ensure that the keys are valid
+                validate(key, error_token)
+                found = {}
+                target[intern(key)] = found
+            target = found
             
-            # Int
+            # Remember it for next time
+            tables[path] = target
+            owner = owners[path[:-1]]
+            if owner is not None:
+                nested[owner].append(path)
+            if type(target) == list:
+                owners[path] = path
+                nested[path] = []
             else:
-                try:
-                    return int(token)
-                except ValueError as e:
-                    error_token("Invalid integer value '{}'".format(token))
-        
-        # Something else?
-        else:
-            error_token("Unknown value in assignment")
+                owners[path] = owner
+        return target
+    
+    def forget(path):
+        """Forgets the tables inside the previous element of the array of
+        tables at the given path (or the table at the path itself)"""
+        children = nested.get(path)
+        if children:
+            nested[path] = []
+            for child in children:
+                forget(child)
+                tables.pop(child, None)
+                owners.pop(child, None)
+                nested.pop(child, None)
     
     def assign(final_key, value):
         """Assigns the given value to the key at the given key path in the data"""
         # Validate the key?
-        validate(final_key)
+        validate(final_key, error_token)
+        # The same keys are found again and again, so only keep one of each
+        final_key = intern(final_key)
         # Resolve the target
         # Cached
         if scope is var["last_scope"]:
@@ -469,29 +1120,8 @@ def loads(string):
             
         # Nope
         else:
-            target = data
-            for key in scope:
-                if type(target) == list:
-                    # Get the last element then
-                    target = target[-1]
-                    
-                found = target.get(key, None)
-                # Create intermediate dictionaries
-                if found is None:
-                    # Ensure that the keys are valid
-                    validate(key)
-                    
-                    # Create the stuff
-                    #print("Creating intermediate '{}' for scope {}".format(
-                    #    key, scope
-                    #))
-                    new = {}
-                    target[key] = new
-                    target = new
-                else:
-                    # It's just a dictionary
-                    target = found
-                    
+            target = resolve(scope)
+            
             # Cache it for next time
             var["last_scope"] = scope
             var["last_target"] = target
@@ -517,19 +1147,110 @@ def loads(string):
                 
                 # Assign it :)
                 found.append(value)
+                forget(scope + (final_key,))
             
             else:
                 message = "Duplicate key found: '{}'\n{}".format(
-                    final_key, lines[line_num]
+                    final_key, source_line(window, line_num, buffer)
                 )
                 raise Exception(message)
         
         # No key found
         else:
+            if found is not None:
+                # An empty table (or the like) is replaced, so forget it
+                path = scope + (final_key,)
+                forget(path)
+                tables.pop(path, None)
             # Just assign it :)
             target[final_key] = value
     
-    for (line_num, line) in tokenize(lines):
+    def annotate(annotation):
+        """Remembers the table or array of the current line for an '#@id='
+        comment, or replaces it with the one of an '#@ref=' comment"""
+        name, _, ref_id = annotation[2:].partition("=")
+        if name == "list-id":
+            var["list_id"] = ref_id
+            return
+        if name not in ("id", "ref"):
+            # Just a comment
+            return
+        if not done:
+            error_token("Found '#@{}=' without a table or value".format(name))
+        
+        path = scope if id_brackets else scope + (key,)
+        target = resolve(path[:-1])
+        if type(target) == list:
+            target = target[-1]
+        final_key = path[-1]
+        
+        if name == "id":
+            found = target[final_key]
+            if id_brackets == 2:
+                # The id of an array of tables is the id of its new element
+                found = found[-1]
+            objects[ref_id] = found
+        
+        else:
+            if ref_id not in objects:
+                error_token("Unknown reference '{}'".format(ref_id))
+            found = objects[ref_id]
+            var["last_scope"] = None
+            if (id_brackets == 2) and (type(found) == dict):
+                # Only the new element of the array of tables is replaced
+                target[final_key][-1] = found
+                forget(path)
+                return
+            if (id_brackets == 2) and (len(target[final_key]) > 1):
+                error_token("Found a reference to an array of tables that was already started")
+            replace(target, path, found)
+    
+    def replace(target, path, value):
+        """Replaces the table (or array) at the given path in its target, and
+        forgets the old one"""
+        target[path[-1]] = value
+        forget(path)
+        tables.pop(path, None)
+        owners.pop(path, None)
+        nested.pop(path, None)
+        var["last_scope"] = None
+    
+    def skip_reference(annotation):
+        """Warns (once) about an '#@ref=' comment that isn't resolved, and
+        loads a reference to an array of tables as an empty array, like the
+        other references to arrays"""
+        name, _, ref_id = annotation[2:].partition("=")
+        if name == "list-id":
+            list_ids.add(ref_id)
+            return
+        if name != "ref":
+            return
+        if not var["warned"]:
+            warnings.warn("Found a reference ('#@ref=' comment) on line {}, which is loaded as an empty table or array (load with resolve_refs=True to resolve it)".format(
+                line_num), stacklevel=5) # The caller of 'loads' or 'load'
+            var["warned"] = True
+        if (id_brackets == 2) and done and (ref_id in list_ids):
+            # (Otherwise it's a reference to one of its tables)
+            target = resolve(scope[:-1])
+            if type(target) == list:
+                target = target[-1]
+            if target[scope[-1]] == [{}]:
+                replace(target, scope, [])
+    
+    # Only look at the stats through wrappers, so that they cost nothing
+    # when they aren't used
+    interpret_value = interpret_element = interpret
+    # The elements of packed arrays are interpreted all at once at the end
+    packed = array_mode != "list"
+    if packed:
+        interpret_element = keep_token
+    if stats is not None:
+        tokens = stats.tokens(tokens)
+        interpret_value = stats.interpreter(interpret, "values")
+        interpret_element = stats.interpreter(interpret_element, "array_elements")
+        assign = stats.assigner(assign, lambda: scope is var["last_scope"])
+    
+    for (line_num, line) in tokens:
         # Set the environment
         array_depth = 0 # How many open brackets are left? [ => 1
         id_brackets = 0 # 1 or 2 depending on type
@@ -539,14 +1260,16 @@ def loads(string):
         value = None
         done = False
         arr = []
+        annotation = None
         
         # Parse the tokens
         for (token, offset) in line:
             # Priority of checks
             # Comment
             if token.startswith("#"):
-                # TODO do that ID assignment stuff here
-                pass
+                # The ids and references of the writer
+                if token.startswith("#@"):
+                    annotation = token
                 
             # Done
             elif done:
@@ -564,7 +1287,7 @@ def loads(string):
                         # Dict
                         if id_brackets == 1:
                             #print("Found dictionary")
-                            new_scope = key.split(".")
+                            new_scope = tuple(key.split("."))
                             scope = new_scope[:-1]
                             assign(new_scope[-1], {})
                             scope = new_scope
@@ -572,39 +1295,35 @@ def loads(string):
                         # Array of dicts
                         else:
                             #print("Found array of dictionaries")
-                            # Check whether it is started
-                            new_dict_array = False
-                            target = data
-                            for part in key.split("."):
-                                if type(target) == list:
-                                    target = target[-1]
-                                target = target.get(part, None)
-                                if target == None:
-                                    new_dict_array = True
-                                    break
+                            new_scope = tuple(key.split("."))
+                            found = tables.get(new_scope)
                             
-                            # It hasn't started     
-                            if new_dict_array:
-                                #print("- Creating new array {}".format(key))
-                                new_scope = key.split(".")
-                                scope = new_scope[:-1]
-                                # Create the array with the first dict
-                                arr = [{}]
-                                assign(new_scope[-1], arr)
-                                #print("Arr: {}".format(arr))
-                                #print("Data:")
-                                #pprint.pprint(data)
-                                #var["last_target"] = arr
+                            # It is known, so just add the new element
+                            if type(found) == list:
+                                found.append({})
+                                forget(new_scope)
                                 scope = new_scope
-                                #print("- Scope: {}".format(scope))
                             
-                            # If it has started
                             else:
-                                #print("- Appending to array")
-                                new_scope = key.split(".")
+                                # Check whether it is started
                                 scope = new_scope[:-1]
-                                assign(new_scope[-1], {})
+                                target = resolve(scope)
+                                if type(target) == list:
+                                    target = target[-1]
+                                
+                                # It hasn't started     
+                                if target.get(new_scope[-1], None) is None:
+                                    #print("- Creating new array {}".format(key))
+                                    # Create the array with the first dict
+                                    arr = [{}]
+                                    assign(new_scope[-1], arr)
+                                
+                                # If it has started
+                                else:
+                                    #print("- Appending to array")
+                                    assign(new_scope[-1], {})
                                 scope = new_scope
+                                resolve(scope)
                             
                         done = True
                     else:
@@ -616,13 +1335,12 @@ def loads(string):
                 if array_depth:
                     # Start sub-array
                     if token == "[":
-                        # Resolve the target
-                        arr_target = value
-                        for i in range(array_depth - 1):
-                            arr_target = arr_target[-1]
-                        
-                        # Add to it :)
-                        arr_target.append([])
+                        # Add it to the innermost array, and make it the
+                        # innermost array itself
+                        new = []
+                        arr_target.append(new)
+                        open_arrays.append(arr_target)
+                        arr_target = new
                         array_depth += 1
                     
                     # End array
@@ -631,7 +1349,11 @@ def loads(string):
                         # Check if it is the definitive end
                         if array_depth == 0:
                             done = True
+                            if packed:
+                                value = pack_array(value, array_mode, error_token)
                             assign(key, value)
+                        else:
+                            arr_target = open_arrays.pop()
                     
                     # New value
                     else:
@@ -639,13 +1361,8 @@ def loads(string):
                         #    line_num, value, array_depth))
                         #print(lines[line_num])
                         
-                        # Resolve the target
-                        arr_target = value
-                        for i in range(array_depth - 1):
-                            arr_target = arr_target[-1]
-                        
-                        # Add the value of the token
-                        arr_target.append(interpret(token))
+                        # Add the value of the token to the innermost array
+                        arr_target.append(interpret_element(token, error_token))
                 
                 # Not inside an array
                 else:
@@ -653,10 +1370,12 @@ def loads(string):
                     if token == "[":
                         array_depth += 1
                         value = []
+                        arr_target = value # The innermost open array
+                        open_arrays = [] # The arrays around it
                     
                     # The assignment is done!
                     else:
-                        assign(key, interpret(token))
+                        assign(key, interpret_value(token, error_token))
                         done = True
             
             # The line isn't really started
@@ -689,17 +1408,503 @@ def loads(string):
                 error_token("Incomplete identifier")
             else:
                 error_token("Incomplete assignment")
+        
+        if resolve_refs:
+            if (id_brackets == 2) and var["list_id"]:
+                # The array of tables that the '#@list-id=' was for
+                target = resolve(scope[:-1])
+                if type(target) == list:
+                    target = target[-1]
+                objects[var["list_id"]] = target[scope[-1]]
+                var["list_id"] = None
+            if annotation:
+                annotate(annotation)
+        elif annotation:
+            skip_reference(annotation)
+
+        if step:
+            next_pause -= 1
+            if not next_pause:
+                next_pause = step
+                yield
+
+def copy_data(data):
+    """Returns a copy of the given loaded data, where only the dictionaries and
+    lists are copied (the other values can't be changed anyway)"""
+    if type(data) == dict:
+        return {key: copy_data(value) for (key, value) in data.items()}
+    elif type(data) == list:
+        return [copy_data(value) for value in data]
+    return data
+
+def freeze(data):
+    """Returns a read-only version of the given loaded data, where dictionaries
+    become mapping proxies and lists become tuples"""
+    if type(data) == dict:
+        return types.MappingProxyType(
+            {key: freeze(value) for (key, value) in data.items()})
+    elif type(data) == list:
+        return tuple(freeze(value) for value in data)
+    return data
+
+def dedupe_data(data):
+    """Interns the keys and strings of the given loaded data, and replaces
+    structurally identical leaf tables (with only values and arrays) and
+    arrays (of values or arrays) with one shared read-only object: a mapping
+    proxy or a tuple, like 'freeze'. The other tables and arrays are changed
+    in place (also the values in the columns of Columns). Returns the data"""
+    intern = sys.intern
+    shared = {} # Structure: the shared object
+    visited = {} # id: (value, structure), for data found more than once
+    
+    def visit(value):
+        """Returns the value to use instead of the given one, and its
+        structure, or None if it can't be shared"""
+        t = type(value)
+        if t is str:
+            value = intern(value)
+            return (value, (t, value))
+        elif t is float:
+            # So that -0.0 isn't shared with 0.0
+            return (value, (t, value.hex()))
+        elif t is datetime.datetime:
+            # Equal datetimes can have different offsets
+            return (value, (t, value, value.utcoffset()))
+        elif (t is not dict) and (t is not list) and (t is not Columns):
+            try:
+                hash(value)
+            except TypeError:
+                # Like packed arrays
+                return (value, None)
+            return (value, (t, value))
+        
+        if id(value) in visited:
+            return visited[id(value)]
+        visited[id(value)] = (value, None) # For data that contains itself
+        
+        if t is Columns:
+            # Arrays of tables (with array_tables="columns") aren't shared, but
+            # the values in their tables are
+            columns = {}
+            for (key, column) in value.columns.items():
+                if type(column) is list:
+                    column[:] = [visit(item)[0] for item in column]
+                columns[intern(key)] = column
+            value.columns = columns
+            return visited[id(value)]
+        
+        if t is dict:
+            items = []
+            structure = []
+            for (key, item) in value.items():
+                (item, item_structure) = visit(item)
+                key = intern(key)
+                items.append((key, item))
+                if structure is not None:
+                    if (item_structure is None) or (item_structure[0] is dict):
+                        # Tables with tables aren't leaf tables
+                        structure = None
+                    else:
+                        structure.append((key, item_structure))
+        else:
+            items = []
+            structure = []
+            for item in value:
+                (item, item_structure) = visit(item)
+                items.append(item)
+                if structure is not None:
+                    if (item_structure is None) or (item_structure[0] is dict):
+                        # Arrays of tables
+                        structure = None
+                    else:
+                        structure.append(item_structure)
+        
+        if structure is None:
+            if t is dict:
+                value.clear()
+                value.update(items)
+            else:
+                value[:] = items
+            result = (value, None)
+        else:
+            structure = (t, tuple(structure))
+            found = shared.get(structure)
+            if found is None:
+                found = types.MappingProxyType(dict(items)) if t is dict else tuple(items)
+                shared[structure] = found
+            result = (found, structure)
+        visited[id(value)] = result
+        return result
     
-    # Return the constructed dictionary
+    # The top-level table stays a dictionary
+    items = [(intern(key), visit(item)[0]) for (key, item) in data.items()]
+    data.clear()
+    data.update(items)
+    # 'visit' refers to itself, so don't let it keep the old data around
+    visited.clear()
+    shared.clear()
     return data
 
-def load(file):
-    """Loads TOML from the given file path or file-like-object"""
+def data_size(data):
+    """Returns the approximate size of the given loaded data in bytes"""
+    size = sys.getsizeof(data)
+    if type(data) == dict:
+        for (key, value) in data.items():
+            size += sys.getsizeof(key) + data_size(value)
+    elif type(data) == list:
+        for value in data:
+            size += data_size(value)
+    return size
+
+class ParseCache:
+    """A bounded LRU cache of loaded files, which are looked up by their real
+    path and used as long as the mtime and size of the file are the same"""
+    def __init__(self, max_entries=128, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() # path: [stamp, data, frozen, size]
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def load(self, path, engine="regex", mmap=False, readonly=False,
+            disk_cache=False, stats=None):
+        """Loads the file at the given path, or returns a copy of the cached
+        data. With 'readonly', a shared read-only view is returned instead"""
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and (entry[0] == stamp):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                if readonly and (entry[2] is None):
+                    entry[2] = freeze(entry[1])
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry:
+            return entry[2] if readonly else copy_data(entry[1])
+
+        data = load(path, engine, mmap, disk_cache=disk_cache, stats=stats)
+        entry = [stamp, data, None, data_size(data)]
+        result = freeze(data) if readonly else copy_data(data)
+        if readonly:
+            entry[2] = result
+
+        with self.lock:
+            self.remove(path)
+            if entry[3] <= self.max_bytes:
+                self.entries[path] = entry
+                self.total_bytes += entry[3]
+            while (len(self.entries) > self.max_entries) or (
+                    self.total_bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+        return result
+
+    def remove(self, path):
+        """Removes the given path from the cache (without locking)"""
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.total_bytes -= entry[3]
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """Returns the counters of the cache as a dictionary"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes
+            }
+
+# The cache used by 'load' with 'cache=True'
+parse_cache = ParseCache()
+
+def load(file, engine="regex", mmap=False, cache=False, readonly=False,
+        disk_cache=False, stats=None, array_mode="list", resolve_refs=False,
+        dedupe=False, array_tables="list"):
+    """Loads TOML from the given file path or file-like-object.
+    With 'mmap', the file at the path is memory-mapped and parsed from its
+    bytes, instead of being read as text.
+    With 'cache' (True or a ParseCache), files at a path are only parsed again
+    when they change, and each call gets its own copy of the data, or a shared
+    read-only view with 'readonly'.
+    With 'disk_cache' (True or a DiskCache), the loaded data is saved on disk,
+    so that other processes don't need to parse the file again.
+    If 'stats' (a Stats) is given, the timings and counters of the parsing
+    are added to it (nothing is added when the data comes from a cache).
+    'array_mode', 'resolve_refs', 'dedupe' and 'array_tables' work like for
+    'loads', but not with the caches"""
+    if (array_mode != "list") and (cache or disk_cache):
+        raise ValueError("array_mode='{}' can't be used with the caches".format(
+            array_mode))
+    if resolve_refs and (cache or disk_cache):
+        raise ValueError("resolve_refs can't be used with the caches")
+    if dedupe and (cache or disk_cache):
+        raise ValueError("dedupe can't be used with the caches")
+    if (array_tables != "list") and (cache or disk_cache):
+        raise ValueError("array_tables='{}' can't be used with the caches".format(
+            array_tables))
     if type(file) == str:
+        if cache:
+            if cache is True:
+                cache = parse_cache
+            return cache.load(file, engine, mmap, readonly, disk_cache, stats)
+        if disk_cache:
+            if disk_cache is True:
+                disk_cache = diskcache.disk_cache
+            return disk_cache.load(file,
+                lambda path: load(path, engine, mmap, stats=stats))
+        if mmap:
+            with open(file, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return {}
+                with mmap_module.mmap(f.fileno(), 0, access=mmap_module.ACCESS_READ) as buffer:
+                    return load_lines(buffer_lines(buffer), engine,
+                        buffer=buffer, stats=stats, array_mode=array_mode,
+                        resolve_refs=resolve_refs, dedupe=dedupe,
+                        array_tables=array_tables)
         with open(file) as f:
-            return loads(f.read())
+            return load_lines(f, engine, stats=stats, array_mode=array_mode,
+                resolve_refs=resolve_refs, dedupe=dedupe, array_tables=array_tables)
     else:
-        return loads(file.read())
+        if mmap:
+            raise ValueError("mmap can only be used with a file path")
+        return load_lines(file, engine, stats=stats, array_mode=array_mode,
+            resolve_refs=resolve_refs, dedupe=dedupe, array_tables=array_tables)
+
+def iterparse(source, engine="regex"):
+    """Parses TOML from the given file path or iterable of lines without
+    building the dictionary. Yields (event, path, value, line_num) tuples:
+        ("table", path, None, line_num)         for [ path ]
+        ("array_table", path, None, line_num)   for [[ path ]]
+        ("value", path, value, line_num)        for path = value and for
+                                                each element of an array
+        ("array_start", path, None, line_num)   for each opening bracket
+        ("array_end", path, None, line_num)     and each closing bracket
+    'path' is the full dotted path of the table or key"""
+    if type(source) == str:
+        with open(source) as f:
+            yield from iterparse(f, engine)
+        return
+
+    window = collections.deque(maxlen=error_window)
+    lines = recent_lines(source, window)
+    scope = ""
+
+    def error_token(msg):
+        """Raises an exception with some debug info :)"""
+        arrmsg = " in array starting" if array_depth else ""
+        message = msg + arrmsg + " on line {}:\n{}\n{}".format(
+            line_num, source_line(window, line_num), "~" * offset + "^")
+        raise Exception(message)
+
+    for (line_num, line) in tokenizers[engine](lines):
+        array_depth = 0
+        id_brackets = 0
+        assignment = False
+        started = False
+        key = None
+        path = None
+        done = False
+
+        for (token, offset) in line:
+            # Comment
+            if token.startswith("#"):
+                pass
+
+            elif done:
+                error_token("Found token after completed statement")
+
+            # [ Dictionary.identifier ] or [[ Array.identifier ]]
+            elif id_brackets:
+                if not key:
+                    key = token
+                elif token == "]" * id_brackets:
+                    for part in key.split("."):
+                        validate(part, error_token)
+                    scope = key
+                    if id_brackets == 1:
+                        yield ("table", key, None, line_num)
+                    else:
+                        yield ("array_table", key, None, line_num)
+                    done = True
+                else:
+                    error_token("Expected closing bracket")
+
+            elif assignment:
+                if token == "[":
+                    array_depth += 1
+                    yield ("array_start", path, None, line_num)
+
+                elif array_depth and (token == "]"):
+                    array_depth -= 1
+                    yield ("array_end", path, None, line_num)
+                    if array_depth == 0:
+                        done = True
+
+                else:
+                    yield ("value", path, interpret(token, error_token), line_num)
+                    if not array_depth:
+                        done = True
+
+            # The line isn't really started
+            else:
+                if key:
+                    if token != "=":
+                        error_token("Missing assignment operator")
+                    validate(key, error_token)
+                    path = scope + "." + key if scope else key
+                    assignment = True
+                elif token == "[":
+                    id_brackets = 1
+                elif token == "[[":
+                    id_brackets = 2
+                else:
+                    key = token
+                started = True
+
+        if started and (not done):
+            if id_brackets:
+                error_token("Incomplete identifier")
+            else:
+                error_token("Incomplete assignment")
+
+def decode_lines(file, offsets=None):
+    """Yields the lines of the given binary file as strings without their line
+    endings. If a deque is given as 'offsets', the byte offsets of the most
+    recent lines are kept in it as (line_num, offset)"""
+    offset = 0
+    for line_num, line in enumerate(file):
+        if offsets is not None:
+            offsets.append((line_num, offset))
+            offset += len(line)
+        if line.endswith(b"\r\n"):
+            line = line[:-2]
+        elif line.endswith(b"\n"):
+            line = line[:-1]
+        yield line.decode("utf-8")
+
+def scan_headers(file, engine="regex", root_keys=None):
+    """Tokenizes the given binary file and yields (key, brackets, offset,
+    line_num) for each [table] (brackets = 1) or [[array]] (brackets = 2),
+    where 'offset' is the byte offset of the line. If a list is given as
+    'root_keys', the keys assigned before the first table are added to it"""
+    # The offsets of the lines that the tokenizer has read since the start of
+    # the current statement, so that the first of them is always its own
+    offsets = collections.deque()
+    lines = decode_lines(file, offsets)
+    found = False
+    for (line_num, line) in tokenizers[engine](lines):
+        while offsets[0][0] < line_num:
+            offsets.popleft()
+        first = line[0][0]
+        if (first == "[") or (first == "[["):
+            if len(line) < 2:
+                continue # Let the parser complain about it later
+            found = True
+            yield (line[1][0], len(first), offsets[0][1], line_num)
+        elif (root_keys is not None) and (not found) and (len(line) > 1) and (
+                line[1][0] == "="):
+            root_keys.append(first)
+
+def parse_section(path, start, end, line_num, data, engine="regex"):
+    """Parses the bytes from 'start' to 'end' (or the end of the file) of the
+    file at the given path into the given data. 'line_num' is the number of
+    the first line"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        if end is None:
+            text = f.read()
+        else:
+            text = f.read(end - start)
+    load_lines(decode_lines(io.BytesIO(text)), engine, data, line_num)
+
+class LazyDocument(collections.abc.Mapping):
+    """A read-only mapping of the top-level keys in a TOML file, which only
+    parses the tables of a key the first time it is accessed"""
+    def __init__(self, path, engine="regex"):
+        self.path = path
+        self.engine = engine
+        self.root_keys = [] # The keys assigned before the first table
+        self.root_run = (0, None, 0)
+        self.runs = {} # top-level key: [(start, end, line_num), ..]
+        self.root = None
+        self.tables = {} # The tables that have been parsed
+        self.scan()
+
+    def scan(self):
+        """Finds the byte offsets of the sections belonging to each
+        top-level key"""
+        headers = [] # (top-level key, offset, line_num)
+        with open(self.path, "rb") as f:
+            for (key, _, offset, line_num) in scan_headers(
+                    f, self.engine, self.root_keys):
+                headers.append((key.split(".")[0], offset, line_num))
+
+        # Each section runs until the next header
+        if headers:
+            self.root_run = (0, headers[0][1], 0)
+        last = None
+        for num, (key, offset, line_num) in enumerate(headers):
+            end = headers[num + 1][1] if num + 1 < len(headers) else None
+            # Merge it with the previous section of the same key
+            if key == last:
+                start, _, first_line = self.runs[key][-1]
+                self.runs[key][-1] = (start, end, first_line)
+            else:
+                self.runs.setdefault(key, []).append((offset, end, line_num))
+            last = key
+
+    def parse_run(self, run, data):
+        """Parses a section of the file into the given data"""
+        start, end, line_num = run
+        parse_section(self.path, start, end, line_num, data, self.engine)
+
+    def __getitem__(self, key):
+        if key in self.tables:
+            return self.tables[key]
+
+        if key in self.runs:
+            data = {}
+            for run in self.runs[key]:
+                self.parse_run(run, data)
+            self.tables[key] = data[key]
+            return data[key]
+
+        if self.root is None:
+            self.root = {}
+            self.parse_run(self.root_run, self.root)
+        return self.root[key]
+
+    def __iter__(self):
+        yield from self.root_keys
+        for key in self.runs:
+            if key not in self.root_keys:
+                yield key
+
+    def __len__(self):
+        return len(self.root_keys) + len(
+            [key for key in self.runs if key not in self.root_keys])
+
+def load_lazy(path, engine="regex"):
+    """Returns a mapping of the TOML file at the given path, which only
+    parses the tables of a top-level key when it is first accessed"""
+    return LazyDocument(path, engine)
 
 def test_load():
     import pprint
@@ -834,6 +2039,149 @@ without = "any trailing whitespace"
     #dic = reader.loads(doc)
     #pprint.pprint(dic)
 
+def test_refs():
+    """Checks loading the '#@id=' and '#@ref=' comments of the writer"""
+    doc = "\n".join([
+        "#@list-id=1",
+        "[[ a ]] #@id=2",
+        "x = 1",
+        "[[ b ]] #@ref=1",
+        "#@list-id=3",
+        "[[ c ]] #@ref=2",
+        "[ d ] #@ref=2",
+    ])
+    data = loads(doc, resolve_refs=True)
+    assert data["a"] is data["b"]
+    assert data["c"][0] is data["d"] is data["a"][0]
+    
+    # Without resolve_refs, the references are empty (also the reference to
+    # an array of tables), with a warning
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        data = loads(doc)
+    assert data == {"a": [{"x": 1}], "b": [], "c": [{}], "d": {}}
+    assert len(caught) == 1 and "resolve_refs" in str(caught[0].message)
+    # It points at the caller of 'loads'
+    assert caught[0].filename == __file__
+
+def test_dedupe():
+    """Checks that identical leaf tables and arrays are shared, also inside
+    arrays of tables loaded as Columns"""
+    doc = "\n".join([
+        "[[ hosts ]]",
+        "tags = [ \"a\", \"b\", ]",
+        "[ hosts.sub ]",
+        "mtu = 1500",
+        "[[ hosts ]]",
+        "tags = [ \"a\", \"b\", ]",
+        "[ hosts.sub ]",
+        "mtu = 1500",
+    ])
+    for array_tables in ("list", "columns"):
+        hosts = loads(doc, dedupe=True, array_tables=array_tables)["hosts"]
+        assert hosts[0]["sub"] is hosts[1]["sub"], array_tables
+        assert type(hosts[0]["sub"]) is types.MappingProxyType
+        assert hosts[0]["tags"] is hosts[1]["tags"] == ("a", "b")
+
+def test_mmap():
+    """Checks that memory-mapped files load like text, with either engine"""
+    import tempfile
+    doc = 'név = "ő"\n[tábla]\nkéy = rossz\n'
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "test.toml")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(doc)
+        messages = set()
+        for engine in tokenizers:
+            for use_mmap in (False, True):
+                try:
+                    load(path, engine, mmap=use_mmap)
+                except Exception as e:
+                    messages.add(str(e))
+        # The errors point at the same character (not byte)
+        assert len(messages) == 1 and messages.pop().endswith("\n~~~~~~^")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(doc.replace("rossz", "1"))
+        for engine in tokenizers:
+            assert load(path, engine, mmap=True) == {"név": "ő", "tábla": {"kéy": 1}}
+        # Whitespace that only str patterns know of (a no-break space)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("a\xa0= 1\n[ t\xa0]\nb = 2\x1f\n")
+        expected = load(path)
+        assert expected == {"a": 1, "t": {"b": 2}}, expected
+        for engine in tokenizers:
+            assert load(path, engine, mmap=True) == expected, engine
+        with open(path) as f:
+            try:
+                load(f, mmap=True)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("mmap was ignored for a file object")
+
+def test_array_mode():
+    """Checks that array_mode only changes the type of the arrays, and never
+    whether a document can be loaded"""
+    arrays = [
+        "[ 1, 2, ]",
+        "[ 1.5, -2.0, +3.25, ]",
+        "[ 1.5e-10, 2.0, ]",
+        "[ -1.5e-3, 2.0, ]",
+        "[ 2.5E+3, 2.0, ]",
+        "[ 1e5, ]",
+        "[ .5, 1.0, ]",
+        "[ 1, 2.0, ]",
+        "[ [ 1, 2, ], [ 3.5, ], ]",
+        "[ 1979-05-27T07:32:00Z, ]",
+    ]
+
+    def plain(value):
+        """Turns the packed arrays in a loaded value into lists"""
+        if hasattr(value, "tolist"):
+            value = value.tolist()
+        if type(value) == list:
+            return [plain(item) for item in value]
+        return value
+
+    array_modes = ["list", "array"]
+    try:
+        import_numpy()
+        array_modes.append("numpy")
+    except ImportError:
+        pass
+    for text in arrays:
+        results = []
+        for array_mode in array_modes:
+            try:
+                results.append(plain(loads("a = " + text, array_mode=array_mode)["a"]))
+            except Exception:
+                results.append("error")
+        assert all(result == results[0] for result in results), (text, results)
+
+def test_scan_headers():
+    """Checks that the offsets of the headers point at their lines, also far
+    after the previous statement"""
+    doc = "\n".join([
+        "title = \"ő\"",
+        "[ a ]",
+        "\n" * (error_window * 2),
+        "values = [",
+    ] + ["    1,"] * (error_window * 2) + [
+        "]",
+        "[[ b ]]\r",
+        "x = 1",
+        "[ a.c ]",
+    ]).encode("utf-8")
+    for engine in tokenizers:
+        root_keys = []
+        headers = list(scan_headers(io.BytesIO(doc), engine, root_keys))
+        assert [key for (key, _, _, _) in headers] == ["a", "b", "a.c"]
+        assert root_keys == ["title"]
+        lines = doc.split(b"\n")
+        for (key, brackets, offset, line_num) in headers:
+            assert doc[offset:].startswith(b"[" * brackets), (engine, key)
+            assert doc[offset:].startswith(lines[line_num])
+
 def main():
     import json, pprint, sys#, toml
     #print(sys.argv)
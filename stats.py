@@ -0,0 +1,105 @@
+# coding: utf-8
+# tomlstats.py
+"""
+Collects timings and counters from the reader and the writer
+"""
+
+import collections
+import datetime
+import time
+
+class Stats:
+    """Timings (in seconds) and counters of what 'load', 'loads', 'dump' and
+    'dumps' did, when given as their 'stats' argument. Giving the same Stats
+    to several calls adds them up.
+    The reader times 'tokenize' (including reading the lines), 'interpret'
+    ('datetime' is the part of it spent on datetimes), 'assign' and the whole
+    'load', and the writer times the whole 'dump'"""
+    def __init__(self):
+        self.times = collections.Counter()
+        self.counts = collections.Counter()
+
+    def add_time(self, phase, seconds):
+        """Adds to the time spent in the given phase"""
+        self.times[phase] += seconds
+
+    def tokens(self, tokens):
+        """Wraps the (line_num, tokens) stream of a tokenizer, timing it and
+        counting the tokens and tables"""
+        clock = time.perf_counter
+        times = self.times
+        counts = self.counts
+        tokens = iter(tokens)
+        while True:
+            start = clock()
+            try:
+                item = next(tokens)
+            except StopIteration:
+                times["tokenize"] += clock() - start
+                return
+            times["tokenize"] += clock() - start
+
+            line = item[1]
+            counts["tokens"] += len(line)
+            first = line[0][0]
+            if first == "[":
+                counts["tables"] += 1
+            elif first == "[[":
+                counts["array_tables"] += 1
+            yield item
+
+    def interpreter(self, interpret, counter):
+        """Wraps 'interpret', timing it and counting its values as 'counter'"""
+        clock = time.perf_counter
+        times = self.times
+        counts = self.counts
+        def timed_interpret(token, error_token):
+            start = clock()
+            value = interpret(token, error_token)
+            elapsed = clock() - start
+            times["interpret"] += elapsed
+            counts[counter] += 1
+            if type(value) is datetime.datetime:
+                times["datetime"] += elapsed
+                counts["datetimes"] += 1
+            return value
+        return timed_interpret
+
+    def assigner(self, assign, cached):
+        """Wraps the 'assign' of a parser, timing it and counting how often
+        cached() says that the last scope shortcut is used"""
+        clock = time.perf_counter
+        times = self.times
+        counts = self.counts
+        def timed_assign(final_key, value):
+            if cached():
+                counts["scope_cache_hits"] += 1
+            else:
+                counts["scope_cache_misses"] += 1
+            start = clock()
+            assign(final_key, value)
+            times["assign"] += clock() - start
+        return timed_assign
+
+    def lines(self, lines):
+        """Wraps the lines of a writer, counting them and their bytes (with the
+        newlines between them, but not after the last one)"""
+        counts = self.counts
+        separator = 0
+        for line in lines:
+            counts["lines"] += 1
+            counts["bytes_written"] += len(line.encode("utf-8")) + separator
+            separator = 1
+            yield line
+
+    def report(self):
+        """Returns the timings and counters as a plain dictionary"""
+        return {
+            "times": dict(self.times),
+            "counts": dict(self.counts)
+        }
+
+    def clear(self):
+        """Resets the timings and counters"""
+        self.times.clear()
+        self.counts.clear()
@@ -7,7 +7,15 @@ Writes toml files in a fancy way
 
 # TODO validate keys!
 import datetime
+import io
+import itertools
+import os
+import shutil
 import sys
+import time
+import types
+
+from .columns import Columns, Row
 
 class IllegalKeyChar(Exception):
     """An exception for when illegal characters are found in dictionary keys"""
@@ -24,6 +32,38 @@ class MultiTypeArray(Exception):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+class CircularReference(Exception):
+    """An exception for when a dictionary or list contains itself"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+def is_binary(flo):
+    """Returns whether the given file-like object takes bytes"""
+    if isinstance(flo, io.TextIOBase):
+        return False
+    if isinstance(flo, (io.RawIOBase, io.BufferedIOBase)) or hasattr(flo, "sendall"):
+        return True
+    return "b" in getattr(flo, "mode", "")
+
+def is_packed(data):
+    """Returns whether the given data is a packed array (array.array,
+    memoryview or a numpy array) that can be dumped as a list"""
+    return hasattr(data, "tolist") and (type(data) not in (list, dict, str))
+
+def sync_directory(path):
+    """Makes sure that a file renamed into the directory of the given path is
+    saved (where the OS allows it)"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 class TomlWriter:
     stringtrans = {
         ord("\""): "\\\"",
@@ -40,15 +80,41 @@ class TomlWriter:
         datetime.datetime
     }
     
+    arraytypes = {
+        bool,
+        str,
+        list,
+        tuple
+    }
+    # What is written as tables and arrays (also what load makes with
+    # 'dedupe' and array_tables="columns")
+    tabletypes = {
+        dict,
+        types.MappingProxyType,
+        Row
+    }
+    listtypes = {
+        list,
+        tuple,
+        Columns
+    }
+    
     invalid_key_chars = {
         "=", ".", "#", "[", "]"
     }
     
-    def __init__(self):
-        """docstring for init"""
+    def __init__(self, refs=False):
+        """With 'refs', dictionaries and lists that are found more than once
+        are written once with an '#@id=' comment, and as '#@ref=' comments
+        after that (which also allows them to contain themselves). Without
+        it, only the dictionaries and lists around the current value are
+        remembered, and data that contains itself is an error"""
+        self.refs = refs
         self.context = [] # ("name", "dict"|"list")
         self.current = "ERROR"
         self.cache = {}
+        self.kept = []
+        self.active = set() # The ids of the dictionaries and lists being dumped
     
     def simple_dump(self, data):
         """For *simple* data types"""
@@ -58,31 +124,86 @@ class TomlWriter:
         elif type(data) is bool:
             return str(int(data))
         
-        elif type(data) is list:
+        elif type(data) in self.listtypes:
             #print("- Dumping list")
+            if not data:
+                return "[]"
+            self.enter(data)
             arrtype = type(data[0])
-            parts = ["[ "]
-            for num, item in enumerate(data):
-                if type(item) is not arrtype:
-                    self.error_array_type(item, arrtype, num, data, self.current)
-                parts.append(self.simple_dump(item))
-                parts.append(", ")
-            parts.append("]")
-            return "".join(parts)
+            parts = self.dump_items(data, arrtype)
+            if parts is None:
+                # Find the element with the wrong type
+                parts = []
+                for num, item in enumerate(data):
+                    if type(item) is not arrtype:
+                        self.error_array_type(item, arrtype, num, data, self.current)
+                    parts.append(self.simple_dump(item))
+            # The parts can be lazy, so only leave the list once they're made
+            text = "[ " + ", ".join(parts) + ", ]"
+            self.active.discard(id(data))
+            return text
         
         elif type(data) is str:
             return '"{}"'.format(data.translate(self.stringtrans))
         
+        elif is_packed(data):
+            # array.array, memoryview or numpy arrays (and numpy scalars)
+            return self.simple_dump(data.tolist())
+        
         else:
             raise Exception("Unsupported type found: '{}': {}!".format(type(data), data))
     
+    def dump_items(self, data, arrtype):
+        """Returns the dumped elements of a list, all at once, or None if not
+        all of them have the type of the first one"""
+        if (arrtype not in self.simpletypes) and (arrtype not in self.arraytypes):
+            return None
+        # One check for the whole list, instead of one for each element
+        if len(set(map(type, data))) != 1:
+            return None
+        
+        if (arrtype is not list) and (arrtype is not tuple):
+            return self.format_items(data, arrtype)
+        
+        # Nested lists: rows of the same simple type (like the rows of a
+        # matrix) are checked together, and can't contain themselves
+        items = itertools.chain.from_iterable(data)
+        types = set(map(type, items))
+        if (len(types) == 1) and all(data):
+            itemtype = types.pop()
+            if (itemtype is not list) and (itemtype is not tuple) and (
+                    (itemtype in self.simpletypes) or (itemtype in self.arraytypes)):
+                format_items = self.format_items
+                return ["[ " + ", ".join(format_items(row, itemtype)) + ", ]"
+                    for row in data]
+        return map(self.simple_dump, data)
+    
+    def format_items(self, items, itemtype):
+        """Returns the dumped elements of a list of the given simple type"""
+        if itemtype in self.simpletypes:
+            return map(str, items)
+        elif itemtype is bool:
+            return map(str, map(int, items))
+        elif itemtype is str:
+            text = "".join(items)
+            if not any(chr(char) in text for char in self.stringtrans):
+                # Nothing to escape, so they can be quoted together
+                return ['"' + '", "'.join(items) + '"']
+            stringtrans = self.stringtrans
+            return ['"' + item.translate(stringtrans) + '"' for item in items]
+        else:
+            raise Exception("Unsupported type found: '{}': {}!".format(itemtype, items))
+    
     def sortkey(self, val):
         """A key for sorting stuff :)"""
         _ , value = val
         t = type(value)
-        if (t is dict) or (value is None):  # dicts last
+        if (t in self.tabletypes) or (value is None):  # dicts last
+            return 3
+        elif (t in self.listtypes) and value and (type(value[0]) in self.tabletypes):
+            # Arrays of tables are written as tables too, but before them
             return 2
-        elif t is list:  # then lists in the middle
+        elif (t in self.listtypes) or is_packed(value):  # then lists in the middle
             return 1
         else:  # and everything else in sorted order before that
             return 0
@@ -128,6 +249,24 @@ class TomlWriter:
         
         raise WrongKeyType(message)
     
+    def enter(self, data):
+        """Remembers that the given dictionary or list is being dumped, or
+        raises an error if it already is (so it contains itself)"""
+        data_id = id(data)
+        if data_id in self.active:
+            context, _ = self.get_context()
+            if not self.refs:
+                hint = "dump with refs=True to write it as a reference"
+            elif type(data) in self.tabletypes:
+                # The other tables are references by now
+                hint = "the top-level table can't be written as a reference"
+            else:
+                hint = "arrays inside arrays can't be written as references"
+            message = "Found a reference to '{}' inside itself at '{}' ({})".format(
+                self.current, context, hint)
+            raise CircularReference(message)
+        self.active.add(data_id)
+    
     def _get_invalid(self, key):
         """Returns a set of the invalid characters in the given TOML key"""
         invalid = set()
@@ -160,28 +299,31 @@ class TomlWriter:
         if data is None:
             data = {}
         
-        if type(data) == dict:
+        if type(data) in self.tabletypes:
             # Name the context if present
             if self.context:
                 name, contype = self.get_context()
                 # TODO check for illegal dictionary keys
                 
+                if not self.refs:
+                    yield name
                 
                 # Check if it is already cached
-                if id(data) in self.cache:
+                elif id(data) in self.cache:
                     # Get the cached id
                     cid = self.cache_or_find(data)
                     #print("Found cache of {}: {}".format(id(data), cid))
                     
                     # Just make a reference in the output
                     yield name + " #@ref=" + cid
-                    raise StopIteration
+                    return
                 
                 else:
                     # Cache a new thing
                     cid = self.cache_or_find(data)
                     yield name + " #@id=" + cid
             
+            self.enter(data)
             for key, value in sorted(data.items(), key=self.sortkey):
                 self.current = key
                 if type(key) is not str:
@@ -191,7 +333,7 @@ class TomlWriter:
                 self.validate_context(key)
                 
                 # Set the context
-                if type(value) == list:
+                if type(value) in self.listtypes:
                     self.context.append((key, "list"))
                 else:
                     self.context.append((key, "dict"))
@@ -201,30 +343,42 @@ class TomlWriter:
                 
                 # Move out of context again
                 self.context.pop() 
+            self.active.discard(id(data))
                 
-        elif type(data) is list:
+        elif type(data) in self.listtypes:
             # Make sure to avoid errors early, here
             if not self.context:
                 raise Exception("Not in context yet at {}!".format(data))
             
             # empty array
             if len(data) is 0:  
-                yield self.current + " = []"
+                if self.refs:
+                    # Empty lists can be shared too
+                    found = id(data) in self.cache
+                    cid = self.cache_or_find(data)
+                    yield self.current + " = [] " + ("#@ref=" if found else "#@id=") + cid
+                else:
+                    yield self.current + " = []"
                 
             else:
                 # Check if it is cached
-                if id(data) in self.cache:
+                if self.refs and (id(data) in self.cache):
                     cid = self.cache_or_find(data)
                     
                     self.validate_key()
                     
                     # Make a reference to the cached data
-                    yield self.current + " = [] #@ref=" + str(cid)
+                    if type(data[0]) in self.tabletypes:
+                        # As a header, since it's written after the tables
+                        yield self.get_context()[0] + " #@ref=" + str(cid)
+                    else:
+                        yield self.current + " = [] #@ref=" + str(cid)
                     # Then stop this iteration
-                    raise StopIteration
+                    return
 
                 # Cache the list
-                cid = self.cache_or_find(data)
+                if self.refs:
+                    cid = self.cache_or_find(data)
                 
                 # Get the array type
                 arrtype = type(data[0])
@@ -233,21 +387,27 @@ class TomlWriter:
                 arrname = self.current
                 
                 # It's a list of dictionaries
-                if arrtype == dict:  
+                if arrtype in self.tabletypes:  
                     
                     # Add a comment in the code before the array
                     # The special name is because it isn't on the same line as the data
-                    yield "#@list-id=" + cid
+                    if self.refs:
+                        yield "#@list-id=" + cid
                     
+                    self.enter(data)
                     for num, item in enumerate(data):
-                        if type(item) != dict:  # ensure homogenity
+                        if type(item) not in self.tabletypes:  # ensure homogenity
                             self.error_array_type(item, arrtype, num, data, arrname)
                         yield from self.iter_lines(item)
+                    self.active.discard(id(data))
                 
                 # Normal list
                 else:
                     self.validate_key()
-                    yield self.current + " = " + self.simple_dump(data) + " #@id=" + cid
+                    if self.refs:
+                        yield self.current + " = " + self.simple_dump(data) + " #@id=" + cid
+                    else:
+                        yield self.current + " = " + self.simple_dump(data)
                     
         else:
             # Same as above, no context-related errors, pls
@@ -266,35 +426,171 @@ class TomlWriter:
         else:
             nid = str(self.next_id)  # strings
             self.cache[data_id] = nid
+            # Keep it, so that its id isn't reused (by a Row view, say)
+            self.kept.append(data)
             self.next_id += 1
             return nid
     
-    def dump(self, data, flo=sys.stdout):
-        """Dumps the given data into an open flo 
-        (or stdout by default)"""
+    def reset(self):
+        """Prepares the writer for dumping new data"""
         self.cache = {} # python id: cache id
+        self.kept = [] # The cached data
         self.next_id = 1
         self.context = []
-        for line in self.iter_lines(data):
-            print(line, file=flo)
+        self.active = set()
+    
+    def lines(self, data, stats=None):
+        """Returns the lines of the given data, counted by 'stats' if given"""
+        self.reset()
+        lines = self.iter_lines(data)
+        if stats is not None:
+            lines = stats.lines(lines)
+        return lines
+    
+    def chunks(self, data, chunk_size, stats=None):
+        """Yields the lines of the given data joined into chunks of about
+        'chunk_size' characters, and never more (longer lines are split).
+        If the data can't be dumped, the lines before the error are still
+        yielded before the error is raised"""
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1, not {}".format(chunk_size))
+        
+        def pieces(chunk):
+            """Joins the lines of a chunk (with a newline after the last one),
+            in pieces of at most 'chunk_size' characters"""
+            chunk.append("")
+            text = "\n".join(chunk)
+            if len(text) <= chunk_size:
+                yield text
+                return
+            for start in range(0, len(text), chunk_size):
+                yield text[start:start + chunk_size]
+        
+        chunk = []
+        size = 0
+        empty = True
+        try:
+            for line in self.lines(data, stats):
+                empty = False
+                chunk.append(line)
+                size += len(line) + 1
+                if size >= chunk_size:
+                    yield from pieces(chunk)
+                    chunk = []
+                    size = 0
+        except Exception:
+            if chunk:
+                yield from pieces(chunk)
+            if (stats is not None) and (not empty):
+                stats.counts["bytes_written"] += 1 # The last newline
+            raise
+        if chunk:
+            yield from pieces(chunk)
+        if (stats is not None) and (not empty):
+            stats.counts["bytes_written"] += 1 # The last newline
+    
+    def dump(self, data, flo=sys.stdout, stats=None, buffer_size=64 * 1024,
+            atomic=False):
+        """Dumps the given data into an open flo 
+        (or stdout by default), 'buffer_size' characters at a time.
+        The flo can also take bytes (like files opened with "wb" or sockets),
+        or be a path. With 'atomic', the data is written to a temporary file
+        next to the path first, which then replaces the file, so that the
+        file is never left half-written"""
+        if isinstance(flo, (str, os.PathLike)):
+            self.dump_path(data, os.fspath(flo), stats, buffer_size, atomic)
+            return
+        if atomic:
+            raise ValueError("Only a path can be written atomically")
+        
+        if stats is not None:
+            start = time.perf_counter()
+        if hasattr(flo, "sendall"):
+            for chunk in self.chunks(data, buffer_size, stats):
+                flo.sendall(chunk.encode("utf-8"))
+        elif is_binary(flo):
+            for chunk in self.chunks(data, buffer_size, stats):
+                flo.write(chunk.encode("utf-8"))
+        else:
+            for chunk in self.chunks(data, buffer_size, stats):
+                flo.write(chunk)
+        if stats is not None:
+            stats.add_time("dump", time.perf_counter() - start)
+    
+    def dump_path(self, data, path, stats=None, buffer_size=64 * 1024,
+            atomic=False):
+        """Dumps the given data into the file at the given path (see 'dump')"""
+        if not atomic:
+            with open(path, "w") as f:
+                self.dump(data, f, stats, buffer_size)
+            return
+        
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temp_path, "w") as f:
+                self.dump(data, f, stats, buffer_size)
+                f.flush()
+                os.fsync(f.fileno())
+            # Keep the permissions of the file that is replaced
+            try:
+                shutil.copymode(path, temp_path)
+            except FileNotFoundError:
+                pass
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        sync_directory(path)
     
-    def dumps(self, data):
+    def iterdump(self, data, chunk_size=64 * 1024, stats=None):
+        """Yields the dumped data as strings of at most 'chunk_size' characters,
+        which are made as they are needed, so only one of them is in memory at
+        a time. Joined, they are the same as what 'dump' writes"""
+        if stats is None:
+            yield from self.chunks(data, chunk_size)
+            return
+        # Only time the dumping, not what is done with the chunks
+        clock = time.perf_counter
+        elapsed = 0
+        start = clock()
+        for chunk in self.chunks(data, chunk_size, stats):
+            elapsed += clock() - start
+            yield chunk
+            start = clock()
+        stats.add_time("dump", elapsed + clock() - start)
+    
+    def dumps(self, data, stats=None):
         """Dumps the given data into a string"""
-        self.cache = {}
-        self.next_id = 1
-        self.context = []
-        lines = list(self.iter_lines(data))
+        if stats is not None:
+            start = time.perf_counter()
+        lines = list(self.lines(data, stats))
+        if stats is not None:
+            stats.add_time("dump", time.perf_counter() - start)
         return "\n".join(lines)
 
-def dump(data, flo=sys.stdout):
-    """Dumps an object to a file"""
-    writer = TomlWriter()
-    writer.dump(data, flo)
+def dump(data, flo=sys.stdout, stats=None, buffer_size=64 * 1024, atomic=False,
+        refs=False):
+    """Dumps an object to a file (see TomlWriter.dump). Timings and counters
+    are added to 'stats' (a Stats) if it is given, and 'refs' writes shared
+    dictionaries and lists as references (see TomlWriter)"""
+    writer = TomlWriter(refs)
+    writer.dump(data, flo, stats, buffer_size, atomic)
+
+def iterdump(data, chunk_size=64 * 1024, stats=None, refs=False):
+    """Yields the dumped object in chunks of at most 'chunk_size' characters
+    (see TomlWriter.iterdump)"""
+    writer = TomlWriter(refs)
+    return writer.iterdump(data, chunk_size, stats)
 
-def dumps(data):
-    """Dumps an object as a string"""
-    writer = TomlWriter()
-    return writer.dumps(data)
+def dumps(data, stats=None, refs=False):
+    """Dumps an object as a string. Timings and counters are added to 'stats'
+    (a Stats) if it is given, and 'refs' writes shared dictionaries and lists
+    as references (see TomlWriter)"""
+    writer = TomlWriter(refs)
+    return writer.dumps(data, stats)
 
 def main():
     """entry point"""
@@ -409,7 +705,7 @@ def main():
         "more params": recursive["params"]
     }
     
-    dump(recursive)
+    dump(recursive, refs=True)
     
     print("")
     print("=== Error messages === ")
@@ -479,6 +775,107 @@ def main():
     toml.dump(testdict, sys.stdout)
     """
 
+def test_circular_lists():
+    """Checks that lists that contain themselves are errors"""
+    a = [1]
+    a[0] = a
+    b = [[1], [2]]
+    b[1] = b
+    for data in ({"x": a}, {"x": b}, {"x": [[a]]}):
+        try:
+            dumps(data)
+        except CircularReference:
+            pass
+        else:
+            raise AssertionError("No CircularReference for {}".format(data))
+    # With refs, only the top-level table and arrays inside arrays can't be
+    # written as references
+    root = {"x": 1}
+    root["sub"] = {"back": root}
+    for (data, hint) in ((root, "top-level table"), ({"x": a}, "arrays inside arrays"),
+            ({"x": [1]}, None)):
+        for refs in (False, True):
+            try:
+                dumps(data, refs=refs)
+            except CircularReference as e:
+                assert hint, data
+                assert (hint in str(e)) == refs, (refs, str(e))
+                assert ("refs=True" in str(e)) != refs, (refs, str(e))
+            else:
+                assert not hint, data
+    # The same list twice is fine
+    c = [1, 2]
+    assert dumps({"x": [c, c]}) == "x = [ [ 1, 2, ], [ 1, 2, ], ]"
+
+def test_loaded_types():
+    """Checks that what 'load' makes with 'dedupe' and array_tables="columns"
+    (mapping proxies, tuples and Columns) is written like dictionaries and
+    lists"""
+    from .reader import loads
+    doc = "\n".join([
+        "name = \"inventory\"",
+        "[[ hosts ]]",
+        "tags = [ \"a\", \"b\", ]",
+        "grid = [ [ 1, 2, ], [ 3, 4, ], ]",
+        "[ hosts.nic ]",
+        "mtu = 1500",
+        "[[ hosts ]]",
+        "tags = [ \"a\", \"b\", ]",
+        "grid = [ [ 1, 2, ], [ 3, 4, ], ]",
+        "[ hosts.nic ]",
+        "mtu = 1500",
+        "[ limits ]",
+        "cpu = 2",
+    ])
+    expected = dumps(loads(doc))
+    for options in ({"dedupe": True}, {"array_tables": "columns"},
+            {"dedupe": True, "array_tables": "columns"}):
+        data = loads(doc, **options)
+        assert dumps(data) == expected, options
+        assert loads(dumps(data, refs=True), resolve_refs=True) == loads(doc)
+
+def test_bytes_written():
+    """Checks that the 'bytes_written' of the stats is the size of the output"""
+    import io
+    from .stats import Stats
+    data = {"name": "ő", "tags": ["a", "b"], "owner": {"age": 3},
+        "nics": [{"mtu": 1500}, {"mtu": 9000}]}
+    stats = Stats()
+    text = dumps(data, stats)
+    assert stats.counts["bytes_written"] == len(text.encode("utf-8"))
+    for buffer_size in (1, 64 * 1024):
+        stats = Stats()
+        flo = io.BytesIO()
+        dump(data, flo, stats, buffer_size)
+        assert stats.counts["bytes_written"] == len(flo.getvalue())
+
+def test_iterdump():
+    """Checks that the chunks are never longer than 'chunk_size', and that the
+    time spent between them isn't counted as dumping"""
+    from .stats import Stats
+    data = {"short": 1, "long": "x" * 1000, "after": [1, 2, 3]}
+    for chunk_size in (1, 7, 100, 64 * 1024):
+        chunks = list(iterdump(data, chunk_size))
+        assert "".join(chunks) == dumps(data) + "\n"
+        assert max(map(len, chunks)) <= chunk_size, chunk_size
+    stats = Stats()
+    for chunk in iterdump(data, 100, stats):
+        time.sleep(0.01)
+    assert stats.times["dump"] < 0.05, stats.times["dump"]
+
+def test_atomic_mode():
+    """Checks that atomic dumps keep the permissions of the replaced file"""
+    import stat
+    import tempfile
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "test.toml")
+        dump({"a": 1}, path, atomic=True)
+        os.chmod(path, 0o640)
+        dump({"a": 2}, path, atomic=True)
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+        with open(path) as f:
+            assert f.read() == "a = 2\n"
+
 if __name__ == '__main__':
     #main()
     badstring = "hello\nhow\twell\fis this\\ escaped \" //\\?"